@@ -0,0 +1,126 @@
+from array import array
+from receipt import ReceiptService
+
+try:
+    import numpy as np
+except ImportError:
+    # Everything works without NumPy, the aggregations are just plain loops
+    np = None
+
+
+class ReceiptColumns:
+    # All receipt lines from the receipt files stored column by column in
+    # compact arrays, one entry per line:
+    # date, serial_nr, time (seconds after midnight), product, amount, price, campaign.
+    # Dates and product ids are stored as positions in self._dates and
+    # self._product_ids. If NumPy is installed the aggregations are vectorized,
+    # unless use_numpy is False (so both ways can be checked against each other).
+
+    def __init__(self, receipt_service:ReceiptService, use_numpy = True):
+        self._np = np if use_numpy else None
+        self._dates = []
+        self._product_ids = []
+        product_positions = {}
+
+        self._date = array('l')
+        self._serial_nr = array('q')
+        self._time = array('l')
+        self._product = array('l')
+        self._amount = array('d')
+        self._price = array('d')
+        self._campaign = array('b')
+
+        receipt_service.flush()
+        databases = receipt_service.getDatabases()
+
+        for date in sorted(databases.keys()):
+            date_position = len(self._dates)
+            self._dates.append(date)
+
+            for row in databases[date].iterRows(columns = ['serial_nr', 'time', 'product_id', 'amount', 'price', 'campaign']):
+                serial_nr, time_string, product_id, amount, price, campaign = row
+
+                if product_id not in product_positions:
+                    product_positions[product_id] = len(self._product_ids)
+                    self._product_ids.append(product_id)
+
+                hours, minutes, seconds = time_string.split(':')
+
+                self._date.append(date_position)
+                self._serial_nr.append(int(serial_nr))
+                self._time.append(int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+                self._product.append(product_positions[product_id])
+                self._amount.append(float(amount))
+                self._price.append(float(price))
+                self._campaign.append(1 if campaign == 'yes' else 0)
+
+    def __len__(self) -> int:
+        return len(self._serial_nr)
+
+    def usesNumpy(self) -> bool:
+        return self._np is not None
+
+    def _getRevenue(self):
+        if self._np is not None:
+            return self._np.frombuffer(self._amount, dtype = self._np.float64) * self._np.frombuffer(self._price, dtype = self._np.float64)
+
+        return [amount * price for amount, price in zip(self._amount, self._price)]
+
+    def _sumBy(self, groups:array, group_count:int, values) -> list:
+        if self._np is not None:
+            group_array = self._np.frombuffer(groups, dtype = self._np.dtype(groups.typecode))
+            return self._np.bincount(group_array, weights = values, minlength = group_count).tolist()
+
+        sums = [0.0] * group_count
+        for group, value in zip(groups, values):
+            sums[group] += value
+
+        return sums
+
+    def getTotalRevenue(self) -> float:
+        return float(sum(self._getRevenue()))
+
+    def getRevenuePerDate(self) -> dict:
+        sums = self._sumBy(self._date, len(self._dates), self._getRevenue())
+        return dict(zip(self._dates, sums))
+
+    def getRevenuePerProduct(self) -> dict:
+        sums = self._sumBy(self._product, len(self._product_ids), self._getRevenue())
+        return dict(zip(self._product_ids, sums))
+
+    def getUnitsPerProduct(self) -> dict:
+        if self._np is not None:
+            amounts = self._np.frombuffer(self._amount, dtype = self._np.float64)
+        else:
+            amounts = self._amount
+
+        sums = self._sumBy(self._product, len(self._product_ids), amounts)
+        return dict(zip(self._product_ids, sums))
+
+    def getRevenuePerHour(self) -> dict:
+        # hour of day (0-23) -> revenue over all dates
+        if self._np is not None:
+            hours = (self._np.frombuffer(self._time, dtype = self._np.dtype(self._time.typecode)) // 3600).astype(self._np.intp)
+            sums = self._np.bincount(hours, weights = self._getRevenue(), minlength = 24).tolist()
+        else:
+            sums = [0.0] * 24
+            for time, revenue in zip(self._time, self._getRevenue()):
+                sums[time // 3600] += revenue
+
+        return {hour: revenue for hour, revenue in enumerate(sums) if revenue != 0}
+
+    def getCampaignRevenue(self) -> float:
+        if self._np is not None:
+            campaign = self._np.frombuffer(self._campaign, dtype = self._np.int8) == 1
+            return float(self._getRevenue()[campaign].sum())
+
+        return sum(revenue for revenue, campaign in zip(self._getRevenue(), self._campaign) if campaign == 1)
+
+    def getTopSellers(self, count = 10, by_units = False) -> list:
+        # [(product_id, revenue or units)] with the best seller first
+        if by_units:
+            per_product = self.getUnitsPerProduct()
+        else:
+            per_product = self.getRevenuePerProduct()
+
+        return sorted(per_product.items(), key = lambda item: item[1], reverse = True)[:count]
@@ -0,0 +1,743 @@
+import datetime as dt
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from copy import deepcopy
+from analytics import ReceiptColumns
+from categories import PriceType
+from database import makeBackend
+from product import Product, ProductService
+from receipt import NewReceipt, ReceiptLine, ReceiptService
+from report import ReportService
+from store import DataStore
+
+
+def makeCatalog(backend, product_count:int, product_filename = 'products.txt', seed = 1) -> list:
+    # Writes product_count synthetic products and returns their ids.
+    randomizer = random.Random(seed)
+    product_ids = [f"{i + 1:07d}" for i in range(product_count)]
+    rows = [ProductService._colnames]
+
+    for product_id in product_ids:
+        price = round(randomizer.uniform(1, 200), 2)
+        price_type = randomizer.choice(['w', 'q'])
+        rows.append([product_id, f"vara{product_id}", str(price), price_type, '0', '0', '0'])
+
+    backend.openTable(product_filename, ProductService._colnames).overwriteFile(rows)
+    return product_ids
+
+
+def makeDayRows(randomizer:random.Random, product_ids:list, first_serial_nr:int, receipts:int, lines_per_receipt = 5) -> list:
+    # Rows of one receipt file, header first, serial numbers from first_serial_nr
+    rows = [ReceiptService._colnames]
+
+    for i in range(receipts):
+        serial_nr = first_serial_nr + i
+        time_string = f"{8 + i * 12 // receipts:02d}:{i % 60:02d}:00"
+
+        for product_id in randomizer.sample(product_ids, min(lines_per_receipt, len(product_ids))):
+            rows.append([str(serial_nr), time_string, product_id, f"vara{product_id}",
+                         str(float(randomizer.randint(1, 5))), '10.0', 'q', 'no'])
+
+    return rows
+
+
+def makeHistory(backend, product_ids:list, days:int, receipts_per_day = 100, lines_per_receipt = 5, seed = 1) -> int:
+    # Writes one receipt file per day for the days before today and builds the
+    # serial number index. Returns the number of receipts written.
+    randomizer = random.Random(seed)
+    today = dt.date.today()
+    serial_nr = 0
+
+    for day in range(days, 0, -1):
+        date = today - dt.timedelta(days = day)
+        rows = makeDayRows(randomizer, product_ids, serial_nr + 1, receipts_per_day, lines_per_receipt)
+        serial_nr += receipts_per_day
+
+        filename = f"receipt_{date.strftime(ReceiptService.datetime_format)}.txt"
+        backend.openTable(filename, ReceiptService._colnames).overwriteFile(rows)
+
+    if days > 0:
+        receipt_service = ReceiptService(ProductService('products.txt', backend = backend), backend)
+        receipt_service.rebuildIndex()
+        receipt_service.close()
+
+    return serial_nr
+
+
+def replay(store:DataStore, script:list) -> dict:
+    # Runs scripted customers through the services the way CheckoutMenu does.
+    # script is a list of customers, each a list of (product_id, amount).
+    # Returns the measured times in seconds.
+    scan_times = []
+    pay_times = []
+    session_times = []
+
+    for scans in script:
+        start_time = time.perf_counter()
+        product_service = store.getProductService()
+        receipt_service = store.getReceiptService()
+        new_receipt = receipt_service.createNewReceipt()
+        session_times.append(time.perf_counter() - start_time)
+
+        for product_id, amount in scans:
+            start_time = time.perf_counter()
+            prod = product_service.findProduct(product_id)
+            prod.setAmount(amount)
+            new_receipt.addProduct(prod)
+            scan_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        receipt_service.addNewReceipt(new_receipt)
+        pay_times.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    store.close()
+    close_time = time.perf_counter() - start_time
+
+    return {'scan':scan_times, 'pay':pay_times, 'session':session_times, 'close':close_time}
+
+
+def timeLookups(receipt_service, receipt_count:int, lookups = 200, seed = 1) -> list:
+    # Times findReceipt for random serial numbers between 1 and receipt_count
+    randomizer = random.Random(seed)
+    lookup_times = []
+
+    for _ in range(lookups if receipt_count > 0 else 0):
+        serial_nr = str(randomizer.randint(1, receipt_count))
+        start_time = time.perf_counter()
+        receipt_service.findReceipt(serial_nr)
+        lookup_times.append(time.perf_counter() - start_time)
+
+    return lookup_times
+
+
+def makeScript(product_ids:list, customers:int, scans:int, seed = 1) -> list:
+    randomizer = random.Random(seed)
+    return [[(randomizer.choice(product_ids), randomizer.randint(1, 3)) for _ in range(scans)] for _ in range(customers)]
+
+
+def _percentile(times:list, share:float) -> float:
+    # In milliseconds
+    if len(times) == 0:
+        return 0.0
+
+    ordered = sorted(times)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] * 1000
+
+
+def _makeStore(backend, product_count:int, days:int, receipts_per_day:int) -> tuple:
+    # Catalog and history in the current directory, returns (product ids, old receipt count)
+    setup_backend = makeBackend(backend)
+    product_ids = makeCatalog(setup_backend, product_count)
+    old_receipts = makeHistory(setup_backend, product_ids, days, receipts_per_day)
+    setup_backend.close()
+    return product_ids, old_receipts
+
+
+def _readUntil(process:subprocess.Popen, marker:bytes):
+    output = b''
+
+    while marker not in output:
+        data = os.read(process.stdout.fileno(), 4096)
+        if data == b'':
+            raise RuntimeError(f"Program ended before {marker} was printed")
+        output += data
+
+
+def measureStartup(product_count = 1000, days = 30, receipts_per_day = 100, runs = 5) -> dict:
+    # Starts main.py against a synthetic store and measures the time until
+    # the main menu asks for a choice, and until a new customer can scan.
+    # Returns the median of runs in milliseconds.
+    main_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    menu_times = []
+    customer_times = []
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            _makeStore('csv', product_count, days, receipts_per_day)
+
+            for run in range(runs):
+                start_time = time.perf_counter()
+                process = subprocess.Popen([sys.executable, '-u', main_filename], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+                _readUntil(process, b'> ')
+                menu_times.append(time.perf_counter() - start_time)
+
+                process.stdin.write(b'1\n')
+                process.stdin.flush()
+                _readUntil(process, b'Kommando: ')
+                customer_times.append(time.perf_counter() - start_time)
+
+                # Pay an empty receipt (nothing is written) and quit
+                process.communicate(b'pay\n0\n', timeout = 60)
+        finally:
+            os.chdir(old_directory)
+
+    return {'menu_ms':_percentile(menu_times, 0.5), 'first_customer_ms':_percentile(customer_times, 0.5)}
+
+
+def runBenchmark(product_count = 1000, days = 30, receipts_per_day = 100, customers = 50, scans = 20, backend = 'csv') -> dict:
+    # Builds a synthetic store in a temporary directory and replays scripted
+    # customers against it. Startup is the time until both services are
+    # ready, lookups find random old receipts by serial number. Memory is
+    # measured in a second run with tracemalloc, since tracing slows down
+    # the timed run.
+    result = {}
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            product_ids, result['old_receipts'] = _makeStore(backend, product_count, days, receipts_per_day)
+            script = makeScript(product_ids, customers, scans)
+
+            for run in ('timed', 'memory'):
+                if run == 'memory':
+                    tracemalloc.start()
+
+                run_backend = makeBackend(backend)
+                start_time = time.perf_counter()
+                store = DataStore('products.txt', run_backend)
+                store.getReceiptService()
+                startup_time = time.perf_counter() - start_time
+
+                if run == 'memory':
+                    result['startup_memory_kb'] = tracemalloc.get_traced_memory()[0] / 1024
+                else:
+                    result['lookup_p50_ms'] = _percentile(timeLookups(store.getReceiptService(), result['old_receipts']), 0.5)
+
+                times = replay(store, script)
+                run_backend.close()
+
+                if run == 'memory':
+                    result['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+                    tracemalloc.stop()
+                else:
+                    result['startup_ms'] = startup_time * 1000
+                    result['session_p50_ms'] = _percentile(times['session'], 0.5)
+                    result['scan_p50_ms'] = _percentile(times['scan'], 0.5)
+                    result['scan_p99_ms'] = _percentile(times['scan'], 0.99)
+                    result['pay_p50_ms'] = _percentile(times['pay'], 0.5)
+                    result['pay_p99_ms'] = _percentile(times['pay'], 0.99)
+                    result['close_ms'] = times['close'] * 1000
+        finally:
+            os.chdir(old_directory)
+
+    return result
+
+
+def _printReplay(args:list):
+    # [products] [days] [receipts per day] [customers] [scans] [csv|sqlite]
+    result = runBenchmark(*[int(arg) for arg in args[:5]], *args[5:6])
+
+    print(f"Gamla kvitton: {result['old_receipts']}")
+    print(f"Uppstart: {round(result['startup_ms'], 2)} ms, {round(result['startup_memory_kb'])} kB")
+    print(f"Kvittosökning: p50 {round(result['lookup_p50_ms'], 3)} ms")
+    print(f"Ny kund: p50 {round(result['session_p50_ms'], 3)} ms")
+    print(f"Skanning: p50 {round(result['scan_p50_ms'], 3)} ms, p99 {round(result['scan_p99_ms'], 3)} ms")
+    print(f"Betalning: p50 {round(result['pay_p50_ms'], 3)} ms, p99 {round(result['pay_p99_ms'], 3)} ms")
+    print(f"Stängning: {round(result['close_ms'], 2)} ms")
+    print(f"Minne, topp: {round(result['peak_memory_kb'])} kB")
+
+
+def _printStartup(args:list):
+    # [products] [days] [receipts per day]
+    result = measureStartup(*[int(arg) for arg in args[:3]])
+    print(f"Meny visas: {round(result['menu_ms'], 1)} ms")
+    print(f"Första kund kan skanna: {round(result['first_customer_ms'], 1)} ms")
+
+
+def _printBackends(args:list):
+    # [products] [days] [receipts per day]: load, lookup and append on both backends
+    numbers = [int(arg) for arg in args[:3]]
+    print('lager   uppstart ms   sökning ms   ny kund ms   betalning ms')
+
+    for backend in ('csv', 'sqlite'):
+        result = runBenchmark(*numbers, customers = 50, scans = 5, backend = backend)
+        print(f"{backend:7} {result['startup_ms']:11.2f} {result['lookup_p50_ms']:12.3f} "
+              f"{result['session_p50_ms']:12.3f} {result['pay_p50_ms']:14.3f}")
+
+
+def measureSerialAllocation(receipt_counts = (0, 1000, 10000, 100000), allocations = 200) -> list:
+    # Fills today's receipt file with receipt_count receipts and times
+    # createNewReceipt for a single lane and for shared lanes, where every
+    # allocation reads the last row and the counter file. Each new receipt
+    # is paid with one line, so the file keeps growing like on a real day.
+    # Returns one dict per receipt count, times as p50 in milliseconds.
+    results = []
+    old_directory = os.getcwd()
+
+    for receipt_count in receipt_counts:
+        result = {'receipts':receipt_count}
+
+        for shared in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+
+                try:
+                    setup_backend = makeBackend('csv')
+                    product_ids = makeCatalog(setup_backend, 100)
+                    filename = f"receipt_{dt.date.today().strftime(ReceiptService.datetime_format)}.txt"
+                    rows = makeDayRows(random.Random(1), product_ids, 1, receipt_count)
+                    setup_backend.openTable(filename, ReceiptService._colnames).overwriteFile(rows)
+                    result['file_mb'] = os.path.getsize(filename) / 2**20
+
+                    store = DataStore('products.txt', makeBackend('csv'), shared = shared)
+                    prod = store.getProductService().findProduct(product_ids[0])
+                    receipt_service = store.getReceiptService()
+                    allocation_times = []
+
+                    for _ in range(allocations):
+                        start_time = time.perf_counter()
+                        new_receipt = receipt_service.createNewReceipt()
+                        allocation_times.append(time.perf_counter() - start_time)
+
+                        new_receipt.addProduct(prod)
+                        receipt_service.addNewReceipt(new_receipt)
+
+                    store.close()
+                finally:
+                    os.chdir(old_directory)
+
+            result['shared_ms' if shared else 'lane_ms'] = _percentile(allocation_times, 0.5)
+
+        results.append(result)
+
+    return results
+
+
+def _printSerial(args:list):
+    # [receipts in today's file, one or more]
+    receipt_counts = [int(arg) for arg in args] or (0, 1000, 10000, 100000)
+    print('kvitton   fil MB   en kassa ms   delade kassor ms')
+
+    for result in measureSerialAllocation(receipt_counts):
+        print(f"{result['receipts']:7} {result['file_mb']:8.1f} {result['lane_ms']:13.4f} {result['shared_ms']:18.4f}")
+
+
+def measureWriteThroughput(receipts = 1000, receipts_per_write = 20, max_write_delay = 0.01, lines_per_receipt = 5) -> list:
+    # Pays receipts receipts with one receipt per write, receipts_per_write
+    # per write, and receipts_per_write per write or max_write_delay seconds,
+    # each with and without fsync. The time includes the last flush when the
+    # store is closed. Returns one dict per setting with receipts per second.
+    results = []
+    old_directory = os.getcwd()
+    settings = [{'receipts_per_write':1, 'max_write_delay':0.0},
+                {'receipts_per_write':receipts_per_write, 'max_write_delay':0.0},
+                {'receipts_per_write':receipts_per_write, 'max_write_delay':max_write_delay}]
+
+    for fsync in (True, False):
+        for setting in settings:
+            write_settings = dict(setting, fsync_writes = fsync)
+
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+
+                try:
+                    setup_backend = makeBackend('csv')
+                    product_ids = makeCatalog(setup_backend, 100)[:lines_per_receipt]
+                    store = DataStore('products.txt', makeBackend('csv'), write_settings = write_settings)
+                    product_service = store.getProductService()
+                    receipt_service = store.getReceiptService()
+
+                    start_time = time.perf_counter()
+                    for _ in range(receipts):
+                        new_receipt = receipt_service.createNewReceipt()
+                        for product_id in product_ids:
+                            new_receipt.addProduct(product_service.findProduct(product_id))
+                        receipt_service.addNewReceipt(new_receipt)
+                    store.close()
+                    seconds = time.perf_counter() - start_time
+                finally:
+                    os.chdir(old_directory)
+
+            results.append(dict(write_settings, receipts_per_second = receipts / seconds))
+
+    return results
+
+
+def _printWrites(args:list):
+    # [receipts] [receipts per write] [max write delay in seconds]
+    numbers = [int(arg) for arg in args[:2]] + [float(arg) for arg in args[2:3]]
+    print('kvitton/skrivning   max väntan s   fsync   kvitton/s')
+
+    for result in measureWriteThroughput(*numbers):
+        print(f"{result['receipts_per_write']:18} {result['max_write_delay']:14} {'ja' if result['fsync_writes'] else 'nej':>7} "
+              f"{round(result['receipts_per_second']):11}")
+
+
+def measureCatalogLookups(product_counts = (1000, 10000, 100000), lookups = 20000, seed = 1) -> list:
+    # Times findProduct for random ids in catalogs of different sizes.
+    # Returns one dict per catalog size with the mean lookup time in microseconds.
+    results = []
+    old_directory = os.getcwd()
+
+    for product_count in product_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+
+            try:
+                backend = makeBackend('csv')
+                product_ids = makeCatalog(backend, product_count)
+                product_service = ProductService('products.txt', backend = backend)
+                randomizer = random.Random(seed)
+                lookup_ids = [randomizer.choice(product_ids) for _ in range(lookups)]
+
+                start_time = time.perf_counter()
+                for product_id in lookup_ids:
+                    product_service.findProduct(product_id)
+                seconds = time.perf_counter() - start_time
+            finally:
+                os.chdir(old_directory)
+
+        results.append({'products':product_count, 'lookup_us':seconds / lookups * 10**6})
+
+    return results
+
+
+def _printCatalog(args:list):
+    # [products in the catalog, one or more]
+    product_counts = [int(arg) for arg in args] or (1000, 10000, 100000)
+    print('varor     sökning µs')
+
+    for result in measureCatalogLookups(product_counts):
+        print(f"{result['products']:7} {result['lookup_us']:14.2f}")
+
+
+def measureRowMemory(receipts = 40000, lines_per_receipt = 5) -> dict:
+    # Reads one receipt file with iterRows and with getData and returns the
+    # peak memory of each in kB (tracemalloc) and the time of each in ms
+    result = {}
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            backend = makeBackend('csv')
+            product_ids = makeCatalog(backend, 1000)
+            db = backend.openTable('receipt_20000101.txt', ReceiptService._colnames)
+            db.overwriteFile(makeDayRows(random.Random(1), product_ids, 1, receipts, lines_per_receipt))
+            result['rows'] = receipts * lines_per_receipt
+            result['file_kb'] = os.path.getsize('receipt_20000101.txt') / 1024
+
+            for name, read in (('iterRows', lambda: sum(1 for row in db.iterRows())), ('getData', lambda: len(db.getData()))):
+                start_time = time.perf_counter()
+                read()
+                result[f'{name}_ms'] = (time.perf_counter() - start_time) * 1000
+
+                tracemalloc.start()
+                read()
+                result[f'{name}_peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+                tracemalloc.stop()
+        finally:
+            os.chdir(old_directory)
+
+    return result
+
+
+def _printRows(args:list):
+    # [receipts] [lines per receipt]
+    result = measureRowMemory(*[int(arg) for arg in args[:2]])
+    print(f"{result['rows']} rader, {round(result['file_kb'])} kB fil")
+
+    for name in ('iterRows', 'getData'):
+        print(f"{name:9} minne, topp {round(result[f'{name}_peak_kb']):8} kB, tid {round(result[f'{name}_ms'], 1)} ms")
+
+
+def _makeCampaignProducts(count:int) -> list:
+    # count products, every other one on a campaign today with one more scheduled
+    today = dt.datetime.today()
+    products = []
+
+    for i in range(count):
+        prod = Product(f"{i + 1:07d}", f"vara{i + 1:07d}", 10.0 + i, PriceType.quantity)
+        if i % 2 == 0:
+            prod.startCampaign(8.0 + i, today - dt.timedelta(days = 1), today + dt.timedelta(days = 1))
+            prod.addScheduledCampaign(7.0 + i, today + dt.timedelta(days = 7), today + dt.timedelta(days = 14), priority = 1)
+        products.append(prod)
+
+    return products
+
+
+def measureReceiptPricing(lines = 50, receipts = 2000) -> dict:
+    # Builds receipts of lines different products, every other one on a
+    # campaign, and times building (campaign lookup per line), the total,
+    # the file rows and the printed lines. Returns microseconds per receipt.
+    products = _makeCampaignProducts(lines)
+
+    times = {'build':0.0, 'total':0.0, 'rows':0.0, 'print':0.0}
+
+    for serial_nr in range(receipts):
+        start_time = time.perf_counter()
+        new_receipt = NewReceipt(str(serial_nr))
+        for prod in products:
+            new_receipt.addProduct(prod)
+        times['build'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        new_receipt.getTotal()
+        times['total'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        new_receipt.getDataList()
+        times['rows'] += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for line in new_receipt.getProducts():
+            new_receipt.getLineString(line)
+        times['print'] += time.perf_counter() - start_time
+
+    return {f'{name}_us':seconds / receipts * 10**6 for name, seconds in times.items()}
+
+
+def measureScanCopies(products = 50, scans = 20000) -> dict:
+    # Per scan cost of what a receipt keeps of a product, on the same
+    # products: the old way, where findProduct and addProduct each made a
+    # deepcopy, and the new way, a copy from findProduct and a ReceiptLine
+    # snapshot. Returns microseconds per scan.
+    product_list = _makeCampaignProducts(products)
+    price_time = dt.datetime.now()
+    result = {}
+
+    for way in ('deepcopy', 'snapshot'):
+        start_time = time.perf_counter()
+
+        for i in range(scans):
+            prod = product_list[i % products]
+
+            if way == 'deepcopy':
+                deepcopy(deepcopy(prod))
+            else:
+                ReceiptLine.fromProduct(prod.copy(), price_time)
+
+        result[f'{way}_us'] = (time.perf_counter() - start_time) / scans * 10**6
+
+    return result
+
+
+def _printScanCopies(args:list):
+    # [products] [scans]
+    result = measureScanCopies(*[int(arg) for arg in args[:2]])
+    print(f"Två deepcopy: {round(result['deepcopy_us'], 2)} µs per skanning")
+    print(f"ReceiptLine.fromProduct: {round(result['snapshot_us'], 2)} µs per skanning "
+          f"({round(result['deepcopy_us'] / result['snapshot_us'], 1)} gånger snabbare)")
+
+
+def _printPricing(args:list):
+    # [lines per receipt] [receipts]
+    result = measureReceiptPricing(*[int(arg) for arg in args[:2]])
+    print(f"Per kvitto: skanning {round(result['build_us'], 1)} µs, total {round(result['total_us'], 2)} µs, "
+          f"rader {round(result['rows_us'], 1)} µs, utskrift {round(result['print_us'], 1)} µs")
+
+
+def measureLineMemory(days = 365, receipts_per_day = 100, lines_per_receipt = 5) -> dict:
+    # Loads every receipt of days days of history and returns the memory
+    # they take per line item in bytes and the load time. The time is from
+    # the first load, which also makes the row caches, and the memory from a
+    # second load with tracemalloc, which reads them.
+    result = {}
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            _makeStore('csv', 1000, days, receipts_per_day)
+
+            for run in ('cache', 'memory'):
+                if run == 'memory':
+                    tracemalloc.start()
+
+                backend = makeBackend('csv')
+                receipt_service = ReceiptService(ProductService('products.txt', backend = backend), backend)
+                start_memory = tracemalloc.get_traced_memory()[0]
+                start_time = time.perf_counter()
+
+                history = receipt_service.getReceiptsFromDb()
+                receipts = [receipt for date in history for receipt in history[date]]
+
+                load_time = time.perf_counter() - start_time
+                line_count = sum(len(receipt.getProducts()) for receipt in receipts)
+
+                if run == 'memory':
+                    result['bytes_per_line'] = (tracemalloc.get_traced_memory()[0] - start_memory) / line_count
+                    tracemalloc.stop()
+                else:
+                    result['load_ms'] = load_time * 1000
+
+                receipts = None
+                receipt_service.close()
+        finally:
+            os.chdir(old_directory)
+
+    result['lines'] = line_count
+    return result
+
+
+def _printLines(args:list):
+    # [days] [receipts per day] [lines per receipt]
+    result = measureLineMemory(*[int(arg) for arg in args[:3]])
+    print(f"{result['lines']} kvittorader, {round(result['bytes_per_line'])} byte per rad, "
+          f"inläsning {round(result['load_ms'])} ms")
+
+
+def measureBasket(lines = 1000, repeats = 2) -> dict:
+    # One customer scans lines different products, then all of them again
+    # repeats - 1 times (merged into the existing lines). Each scan is timed
+    # the way CheckoutMenu handles it: lookup, addProduct and the printed line
+    # and total. Returns times in milliseconds: scan p50/p99, the mean of the
+    # first and the last 100 scans, the whole basket and its file rows.
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            backend = makeBackend('csv')
+            product_ids = makeCatalog(backend, lines)
+            product_service = ProductService('products.txt', backend = backend)
+        finally:
+            os.chdir(old_directory)
+
+    new_receipt = NewReceipt('1')
+    # Printed to memory instead of the terminal
+    output = io.StringIO()
+    scan_times = []
+    start_basket_time = time.perf_counter()
+
+    for product_id in product_ids * repeats:
+        start_time = time.perf_counter()
+        prod = product_service.findProduct(product_id)
+        prod.setAmount(1)
+        line = new_receipt.addProduct(prod)
+        print(new_receipt.getLineString(line), file = output)
+        print(f"Total: {new_receipt.getTotal()}", file = output)
+        scan_times.append(time.perf_counter() - start_time)
+
+    basket_time = time.perf_counter() - start_basket_time
+    start_time = time.perf_counter()
+    new_receipt.getDataList()
+    rows_time = time.perf_counter() - start_time
+
+    return {'scans':len(scan_times), 'lines':len(new_receipt.getProducts()),
+            'scan_p50_ms':_percentile(scan_times, 0.5), 'scan_p99_ms':_percentile(scan_times, 0.99),
+            'first_100_ms':sum(scan_times[:100]) / len(scan_times[:100]) * 1000,
+            'last_100_ms':sum(scan_times[-100:]) / len(scan_times[-100:]) * 1000,
+            'basket_ms':basket_time * 1000, 'rows_ms':rows_time * 1000}
+
+
+def _printBasket(args:list):
+    # [lines] [times every product is scanned]
+    result = measureBasket(*[int(arg) for arg in args[:2]])
+    print(f"{result['scans']} skanningar, {result['lines']} rader")
+    print(f"Skanning: p50 {round(result['scan_p50_ms'], 4)} ms, p99 {round(result['scan_p99_ms'], 4)} ms, "
+          f"första 100 {round(result['first_100_ms'], 4)} ms, sista 100 {round(result['last_100_ms'], 4)} ms")
+    print(f"Hela korgen: {round(result['basket_ms'], 1)} ms, kvittorader: {round(result['rows_ms'], 2)} ms")
+
+
+def _compareSums(name:str, sums:dict, expected:dict) -> list:
+    # Problems where sums and expected differ by more than rounding
+    problems = []
+
+    for key in set(sums) | set(expected):
+        value = sums.get(key, 0.0)
+        expected_value = expected.get(key, 0.0)
+
+        if abs(value - expected_value) > 1e-6 * max(1.0, abs(expected_value)):
+            problems.append(f"{name} {key}: {value}, expected {expected_value}")
+
+    return problems
+
+
+def checkReceiptColumns(days = 30, receipts_per_day = 200) -> dict:
+    # Builds ReceiptColumns with plain loops and, if NumPy is installed,
+    # vectorized, times both and checks their sums against a SalesReport
+    # of the same days. Returns the build and aggregation times in ms per
+    # way and the problems found.
+    result = {'times':{}, 'problems':[]}
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            _makeStore('csv', 1000, days, receipts_per_day)
+            backend = makeBackend('csv')
+            receipt_service = ReceiptService(ProductService('products.txt', backend = backend), backend)
+            dates = sorted(receipt_service.getDatabases().keys())
+            report = ReportService(receipt_service).makeReport(dates[0], dates[-1])
+            products = report.getProducts()
+
+            for use_numpy in (False, True):
+                start_time = time.perf_counter()
+                columns = ReceiptColumns(receipt_service, use_numpy)
+                build_time = time.perf_counter() - start_time
+
+                if use_numpy and not columns.usesNumpy():
+                    continue
+
+                start_time = time.perf_counter()
+                revenue_per_product = columns.getRevenuePerProduct()
+                units_per_product = columns.getUnitsPerProduct()
+                revenue_per_date = columns.getRevenuePerDate()
+                total_revenue = columns.getTotalRevenue()
+                columns.getRevenuePerHour()
+                columns.getCampaignRevenue()
+                columns.getTopSellers()
+                aggregate_time = time.perf_counter() - start_time
+
+                way = 'numpy' if use_numpy else 'array'
+                result['times'][way] = {'build_ms':build_time * 1000, 'aggregate_ms':aggregate_time * 1000}
+                result['problems'] += _compareSums(f"{way} revenue", revenue_per_product, {key: product['revenue'] for key, product in products.items()})
+                result['problems'] += _compareSums(f"{way} units", units_per_product, {key: product['units'] for key, product in products.items()})
+                result['problems'] += _compareSums(f"{way} date", revenue_per_date, report.getRevenuePerDate())
+                result['problems'] += _compareSums(f"{way} total", {'':total_revenue}, {'':report.getTotalRevenue()})
+
+            receipt_service.close()
+        finally:
+            os.chdir(old_directory)
+
+    return result
+
+
+def _printColumns(args:list):
+    # [days] [receipts per day], exits with code 1 if the sums do not match the report
+    result = checkReceiptColumns(*[int(arg) for arg in args[:2]])
+
+    for way, times in result['times'].items():
+        print(f"{way:6} uppbyggnad {round(times['build_ms'], 1)} ms, summering {round(times['aggregate_ms'], 2)} ms")
+    if 'numpy' not in result['times']:
+        print('NumPy saknas, bara array-vägen kontrollerad')
+
+    for problem in result['problems']:
+        print(problem)
+
+    if len(result['problems']) > 0:
+        sys.exit(1)
+    print('Inga fel')
+
+
+# python bench.py [products] [days] [receipts per day] [customers] [scans] [csv|sqlite]
+# python bench.py <mode> [arguments], see the functions below for the arguments
+modes = {'startup':_printStartup, 'backends':_printBackends, 'serial':_printSerial, 'writes':_printWrites,
+         'catalog':_printCatalog, 'rows':_printRows,
+         'pricing':_printPricing, 'copies':_printScanCopies, 'lines':_printLines,
+         'basket':_printBasket, 'columns':_printColumns}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in modes:
+        modes[sys.argv[1]](sys.argv[2:])
+    else:
+        _printReplay(sys.argv[1:])
@@ -0,0 +1,108 @@
+import datetime as dt
+from bisect import bisect_right
+
+
+class CampaignSchedule:
+    # All campaigns of one product, flattened into sorted non-overlapping
+    # segments so the winning campaign at a time is found with a binary search.
+    # A campaign is active from 00:00 on its start date to the end of its end date.
+    # When campaigns overlap the highest priority wins, on equal priority the
+    # one added last wins.
+
+    def __init__(self, campaigns:list):
+        # campaigns: dicts with 'price', 'start_date', 'end_date' and 'priority'
+        self._boundaries = []
+        self._segments = []
+
+        boundaries = set()
+        for campaign in campaigns:
+            boundaries.add(campaign['start_date'])
+            boundaries.add(getCampaignEnd(campaign))
+        self._boundaries = sorted(boundaries)
+
+        for i, segment_start in enumerate(self._boundaries):
+            winner = None
+
+            for campaign in campaigns:
+                if campaign['start_date'] <= segment_start < getCampaignEnd(campaign):
+                    if winner is None or campaign['priority'] >= winner['priority']:
+                        winner = campaign
+
+            self._segments.append(winner)
+
+    def getActiveCampaign(self, datetime_obj:dt.datetime) -> dict:
+        i = bisect_right(self._boundaries, datetime_obj) - 1
+
+        if i < 0:
+            return None
+
+        return self._segments[i]
+
+
+class CampaignIndex:
+    # Interval tree over the campaigns of a whole catalog, used to find every
+    # product on campaign at a time without looking at every product.
+
+    def __init__(self, intervals:list):
+        # intervals: (start, end, product_id), end not included
+        self._center = None
+        self._by_start = []
+        self._by_end = []
+        self._left = None
+        self._right = None
+
+        # Empty intervals are never active, and would stop the tree from splitting
+        intervals = [interval for interval in intervals if interval[0] < interval[1]]
+
+        if len(intervals) == 0:
+            return
+
+        # The interval with the median start always overlaps the center
+        starts = sorted([interval[0] for interval in intervals])
+        self._center = starts[len(starts) // 2]
+
+        left = []
+        right = []
+        overlapping = []
+
+        for interval in intervals:
+            if interval[1] <= self._center:
+                left.append(interval)
+            elif interval[0] > self._center:
+                right.append(interval)
+            else:
+                overlapping.append(interval)
+
+        self._by_start = sorted(overlapping, key = lambda interval: interval[0])
+        self._by_end = sorted(overlapping, key = lambda interval: interval[1], reverse = True)
+
+        if len(left) > 0:
+            self._left = CampaignIndex(left)
+        if len(right) > 0:
+            self._right = CampaignIndex(right)
+
+    def query(self, datetime_obj:dt.datetime) -> set:
+        product_ids = set()
+        node = self
+
+        while node is not None and node._center is not None:
+            if datetime_obj < node._center:
+                for start, end, product_id in node._by_start:
+                    if start > datetime_obj:
+                        break
+                    product_ids.add(product_id)
+                node = node._left
+
+            else:
+                for start, end, product_id in node._by_end:
+                    if end <= datetime_obj:
+                        break
+                    product_ids.add(product_id)
+                node = node._right
+
+        return product_ids
+
+
+def getCampaignEnd(campaign:dict) -> dt.datetime:
+    # The end date is included in the campaign
+    return campaign['end_date'] + dt.timedelta(days = 1)
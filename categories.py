@@ -9,4 +9,9 @@ class AdminMenuOption(Enum):
     priceAndName = 1
     manageCampaign = 2
     manageReceipts = 3
+    rebuildIndex = 4
+    importFeed = 5
+    showCampaigns = 6
+    salesReport = 7
+    showMetrics = 8
     reset = 99
\ No newline at end of file
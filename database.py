@@ -1,5 +1,23 @@
 import csv
+import io
+import mmap
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, compress
 import os
+import locale
+import re
+import sqlite3
+import threading
+import time
+from metrics import metrics, timed
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 
 class CSVdb:
@@ -11,54 +29,130 @@ class CSVdb:
     def __init__(self, filename:str, colnames:list):
         self._filename = filename
         self._colnames = colnames
+        self._mapped_file = None
+
+    @timed('CSVdb.appendData')
+    def appendData(self, data:list) -> int:
+        # Returns the byte offset in the file where the data starts
+        text = self.formatRows(self.checkRows(data))
+
+        with open(self._filename, 'a', newline = '') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(text)
+
+            if metrics.isEnabled():
+                metrics.addBytes('CSVdb.appendData', written = f.tell() - offset)
 
-    def appendData(self, data:list) -> None:
-        
+        return offset
+
+    def checkRows(self, data:list) -> list:
+        # Accepts a single row or a list of rows, returns a list of rows
         if type(data[0]) == list:
-            single_row = False
+            rows = data
         else:
-            single_row = True
+            rows = [data]
 
-        if single_row:
-            assert len(data) == len(self._colnames)
-        else:
-            row_length_checker = ['error' for row in data if len(row) != len(self._colnames)]
-            assert 'error' not in row_length_checker
+        for row in rows:
+            assert len(row) == len(self._colnames)
 
+        return rows
 
-        with open(self._filename, 'a', newline = '') as f:
-            writer = csv.writer(f, delimiter = self.delimiter)
+    def formatRows(self, rows:list) -> str:
+        # The rows as file text. Raises ValueError if a value has a line break:
+        # MappedFile finds the rows by their line breaks, so every row has to
+        # be one line. Each row ends with \r\n, so counting them is enough.
+        text = io.StringIO()
+        writer = csv.writer(text, delimiter = self.delimiter)
+        writer.writerows(rows)
+        text = text.getvalue()
 
-            if single_row:
-                writer.writerow(data)
-            else:
-                for row in data:
-                    writer.writerow(row)            
+        if text.count('\n') != len(rows) or text.count('\r') != len(rows):
+            raise ValueError(f"Line break in a value written to {self._filename}")
+
+        return text
 
+    def openWriter(self, max_pending = 1, max_delay = 0.0, fsync = True) -> 'CSVWriter':
+        return CSVWriter(self, max_pending, max_delay, fsync)
+
+    @timed('CSVdb.getData')
     def getData(self, get_header = False) -> list:
-        data = []
+        return list(self.iterRows(get_header = get_header))
+
+    def iterRows(self, columns = None, row_filter = None, get_header = False):
+        # Yields one row at a time so the whole file is never held in memory.
+        # columns: names of the columns to keep (in that order), default all
+        # row_filter: function taking the full row, rows where it returns False are skipped
+        if columns is not None:
+            column_indexes = [self._colnames.index(col) for col in columns]
 
         try:
             with open(self._filename, 'r', newline = '') as f:
+                if metrics.isEnabled():
+                    # Every CSV read goes through here, getData included
+                    metrics.addBytes('CSVdb.iterRows', read = os.fstat(f.fileno()).st_size)
+
                 reader = csv.reader(f, delimiter = self.delimiter)
                 header = next(reader)
+
                 if get_header:
-                    data.append(header)
+                    if columns is not None:
+                        header = [header[i] for i in column_indexes]
+                    yield header
+
                 for row in reader:
-                    data.append(row)
+                    if row_filter is not None and not row_filter(row):
+                        continue
+
+                    if columns is not None:
+                        row = [row[i] for i in column_indexes]
+
+                    yield row
 
         except StopIteration: #if csv file is empty
-            pass
+            return
+
+    def getMappedFile(self) -> 'MappedFile':
+        # Kept between calls so the line index only has to be extended when the file grows
+        if self._mapped_file is None:
+            self._mapped_file = MappedFile(self)
+
+        return self._mapped_file
 
-        return data
-    
+    def getLastRow(self) -> list:
+        # Returns None if there are no data rows
+        return self.getMappedFile().getLastRow()
+
+    def iterRowsWithOffsets(self, offset = 0):
+        # Yields (byte offset, row) for each data row, starting at offset.
+        # The offset of a row can later be passed back in to jump straight to it.
+        return self.getMappedFile().iterRowsWithOffsets(offset)
+
+    @timed('CSVdb.overwriteFile')
     def overwriteFile(self, new_data:list) -> None:
+        # Writes a temporary file and then replaces the old file with it,
+        # so a crash in the middle never leaves a half written file behind
         assert len(new_data) > 0
-        with open(self._filename, 'w', newline = '') as f:
-            writer = csv.writer(f, delimiter = self.delimiter)
+        text = self.formatRows(new_data)
+        temp_filename = self._filename + '.tmp'
+
+        with open(temp_filename, 'w', newline = '') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+            if metrics.isEnabled():
+                metrics.addBytes('CSVdb.overwriteFile', written = os.fstat(f.fileno()).st_size)
+
+        os.replace(temp_filename, self._filename)
 
-            for row in new_data:
-                writer.writerow(row)
+    def getFileStamp(self) -> tuple:
+        # (mtime, size) of the file, used to detect changes made by someone else
+        try:
+            stat = os.stat(self._filename)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size)
 
     def convertToDataDict(self, data:list) -> dict:
         data_dict = {}
@@ -74,4 +168,475 @@ class CSVdb:
         return filenames
 
 
-  
+class MappedFile:
+    # Reads a CSVdb file through a read-only memory map, parsing rows straight
+    # from the mapped bytes. Keeps an index of where every data row starts,
+    # which is extended (not rebuilt) when rows have been appended to the file.
+    # A row is always one line, CSVdb.formatRows refuses values with line breaks.
+
+    # Rows parsed at a time by iterRowsWithOffsets
+    block_lines = 4096
+
+    def __init__(self, db:CSVdb):
+        self._db = db
+        self._encoding = locale.getpreferredencoding(False)
+        self._line_offsets = array('q')
+        self._indexed_size = 0
+        self._file_id = None
+
+    def _map(self):
+        # Returns the mapped file, or None if it is missing or empty
+        try:
+            with open(self._db._filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size == 0:
+                    return None
+
+                mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        except FileNotFoundError:
+            return None
+
+        if stat.st_ino != self._file_id or stat.st_size < self._indexed_size:
+            # A new file (e.g. overwriteFile) or a shorter one, start over
+            self._line_offsets = array('q')
+            self._indexed_size = 0
+            self._file_id = stat.st_ino
+
+        return mapped
+
+    def _updateIndex(self, mapped) -> None:
+        position = self._indexed_size
+
+        if position == 0:
+            # skip header
+            header_end = mapped.find(b'\n')
+            position = len(mapped) if header_end == -1 else header_end + 1
+
+        # A last line that is not finished is left until it is
+        end = mapped.rfind(b'\n', position) + 1
+
+        if end > position:
+            # Line starts are summed from the line lengths in one go,
+            # then the blank lines are left out
+            lines = mapped[position:end - 1].split(b'\n')
+            starts = accumulate((len(line) + 1 for line in lines[:-1]), initial = position)
+            self._line_offsets.extend(compress(starts, [line.strip(b'\r') != b'' for line in lines]))
+            position = end
+
+        self._indexed_size = position
+
+    def _parseLine(self, mapped, position:int) -> list:
+        line_end = mapped.find(b'\n', position)
+        if line_end == -1:
+            line_end = len(mapped)
+
+        line = mapped[position:line_end].rstrip(b'\r').decode(self._encoding)
+        return next(csv.reader([line], delimiter = self._db.delimiter))
+
+    def getLineOffsets(self) -> array:
+        mapped = self._map()
+        if mapped is None:
+            return array('q')
+
+        with mapped:
+            self._updateIndex(mapped)
+
+        return self._line_offsets
+
+    def getRowCount(self) -> int:
+        return len(self.getLineOffsets())
+
+    def getRow(self, i:int) -> list:
+        mapped = self._map()
+        if mapped is None:
+            raise IndexError(i)
+
+        with mapped:
+            self._updateIndex(mapped)
+            return self._parseLine(mapped, self._line_offsets[i])
+
+    def iterRowsWithOffsets(self, offset = 0):
+        mapped = self._map()
+        if mapped is None:
+            return
+
+        with mapped:
+            self._updateIndex(mapped)
+            first_line = bisect_left(self._line_offsets, offset)
+
+            # Lines are decoded and split in blocks by one csv.reader,
+            # a reader per line costs several times more
+            for block_start in range(first_line, len(self._line_offsets), self.block_lines):
+                block_end = min(block_start + self.block_lines, len(self._line_offsets))
+                end_position = self._line_offsets[block_end] if block_end < len(self._line_offsets) else self._indexed_size
+
+                text = mapped[self._line_offsets[block_start]:end_position].decode(self._encoding)
+                lines = [line.rstrip('\r') for line in text.split('\n')]
+                rows = csv.reader([line for line in lines if line != ''], delimiter = self._db.delimiter)
+
+                yield from zip(self._line_offsets[block_start:block_end], rows)
+
+            # A last line without a line break is read but not indexed
+            position = max(self._indexed_size, offset)
+            if position < len(mapped) and mapped[position:].strip(b'\r\n') != b'':
+                yield position, self._parseLine(mapped, position)
+
+    def getLastRow(self) -> list:
+        # Searches backwards from the end, so it does not need the line index
+        mapped = self._map()
+        if mapped is None:
+            return None
+
+        with mapped:
+            line_end = len(mapped)
+
+            while line_end > 0:
+                line_start = mapped.rfind(b'\n', 0, line_end - 1) + 1
+
+                if mapped[line_start:line_end].strip(b'\r\n') != b'':
+                    break
+                line_end = line_start
+
+            if line_end == 0:
+                return None
+
+            row = self._parseLine(mapped, line_start)
+
+        if row == self._db._colnames:
+            return None
+
+        return row
+
+
+class SharedLock:
+    # Lock shared by threads in this process and by other processes using the
+    # same lock file, for checkout lanes writing to the same receipt files.
+    # Can be taken again by the thread that already holds it.
+
+    def __init__(self, filename:str):
+        self._filename = filename
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._depth += 1
+
+        if self._depth == 1:
+            self._file = open(self._filename, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+
+        self._thread_lock.release()
+        return False
+
+
+class CSVWriter:
+    # Keeps a CSVdb file open and writes appended data in groups (group commit).
+    #
+    # Durability: data given to appendData is only on disk after a flush.
+    # A flush happens when max_pending appendData calls are waiting, when the
+    # oldest waiting call is older than max_delay seconds (checked on the next
+    # appendData call, there is no background timer), and on flush()/close().
+    # max_delay <= 0 means no time limit, only max_pending decides.
+    # With fsync = True every flush is also fsynced, so flushed data survives
+    # a power loss. Anything not yet flushed is lost if the program crashes.
+    # max_pending = 1 writes every call straight away.
+
+    def __init__(self, db:CSVdb, max_pending = 1, max_delay = 0.0, fsync = True):
+        self._db = db
+        self._max_pending = int(max_pending)
+        self._max_delay = float(max_delay)
+        self._fsync = fsync
+        self._encoding = locale.getpreferredencoding(False)
+
+        self._file = open(db._filename, 'ab')
+        self._position = self._file.seek(0, os.SEEK_END)
+        self._buffer = []
+        self._pending = 0
+        self._first_pending_time = None
+
+    def appendData(self, data:list) -> int:
+        # Returns the byte offset in the file where the data will start
+        encoded = self._db.formatRows(self._db.checkRows(data)).encode(self._encoding)
+
+        offset = self._position
+        self._position += len(encoded)
+        self._buffer.append(encoded)
+
+        if self._pending == 0:
+            self._first_pending_time = time.monotonic()
+        self._pending += 1
+
+        if self._pending >= self._max_pending or 0 < self._max_delay <= time.monotonic() - self._first_pending_time:
+            self.flush()
+
+        return offset
+
+    def hasPending(self) -> bool:
+        return self._pending > 0
+
+    @timed('CSVWriter.flush')
+    def flush(self) -> None:
+        if self._pending == 0:
+            return
+
+        if metrics.isEnabled():
+            metrics.addBytes('CSVWriter.flush', written = sum(len(encoded) for encoded in self._buffer))
+
+        self._file.write(b''.join(self._buffer))
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+        self._buffer = []
+        self._pending = 0
+        self._first_pending_time = None
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+
+class CSVBackend:
+    # Stores every table as its own semicolon separated text file
+
+    def openTable(self, filename:str, colnames:list) -> CSVdb:
+        return CSVdb(filename, colnames)
+
+    def getFilenames(self, contains:str) -> list:
+        return CSVdb.getFilenames(contains)
+
+    def getFileStamps(self, tables:dict) -> dict:
+        # Same keys as tables (key -> table), with the stamp of each table
+        return {key: table.getFileStamp() for key, table in tables.items()}
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend:
+    # Stores every table in one SQLite database file. Tables keep the file
+    # names the CSV backend would use, so the services work the same with
+    # both. All values are stored as text, like in the CSV files.
+
+    def __init__(self, database_filename = 'kassan.db'):
+        # Checkout lanes running as threads share the connection
+        self._connection = sqlite3.connect(database_filename, check_same_thread = False)
+        # With a write-ahead log a commit needs one fsync instead of several,
+        # and lanes reading do not block the lane writing
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS tables (filename TEXT PRIMARY KEY, table_name TEXT, version INTEGER)')
+        self._connection.commit()
+
+    def openTable(self, filename:str, colnames:list) -> 'SQLiteTable':
+        return SQLiteTable(self._connection, filename, colnames)
+
+    def getFilenames(self, contains:str) -> list:
+        cursor = self._connection.execute('SELECT filename FROM tables')
+        return [filename for (filename,) in cursor if contains in filename]
+
+    def getFileStamps(self, tables:dict) -> dict:
+        # One query for all tables instead of one per table
+        versions = dict(self._connection.execute('SELECT filename, version FROM tables'))
+        stamps = {}
+
+        for key, table in tables.items():
+            version = versions.get(table._filename)
+            stamps[key] = (version,) if version is not None else None
+
+        return stamps
+
+    def close(self) -> None:
+        self._connection.commit()
+        self._connection.close()
+
+
+def makeBackend(name:str):
+    # name is 'csv' or 'sqlite'
+    if name == 'csv':
+        return CSVBackend()
+    elif name == 'sqlite':
+        return SQLiteBackend()
+    else:
+        raise ValueError(f"Unknown storage backend {name}")
+
+
+class SQLiteTable(CSVdb):
+    # A CSVdb stored as a table in a SQLite database. Offsets are rowids and
+    # the file stamp is (version,), where the version goes up on every write.
+    # It is only read from the tables table, the stamp is checked often. A row equal to the column names is a header and is not
+    # stored; writing it creates the table, like it creates a CSV file.
+
+    def __init__(self, connection:sqlite3.Connection, filename:str, colnames:list):
+        super().__init__(filename, colnames)
+        self._connection = connection
+        self._table_name = 't_' + re.sub(r'\W', '_', os.path.splitext(os.path.basename(filename))[0])
+        self._column_list = ', '.join(f'"{col}"' for col in colnames)
+
+    def _exists(self) -> bool:
+        cursor = self._connection.execute('SELECT 1 FROM tables WHERE filename = ?', (self._filename,))
+        return cursor.fetchone() is not None
+
+    def _create(self) -> None:
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS {self._table_name} ({self._column_list})')
+
+        for col in ['serial_nr', 'product_id', 'id']:
+            if col in self._colnames:
+                self._connection.execute(f'CREATE INDEX IF NOT EXISTS {self._table_name}_{col} ON {self._table_name} ("{col}")')
+
+        self._connection.execute('INSERT OR IGNORE INTO tables VALUES (?, ?, 0)', (self._filename, self._table_name))
+
+    def _insertRows(self, rows:list) -> int:
+        # Returns rowid of the first inserted row, the caller commits
+        if not self._exists():
+            self._create()
+
+        placeholders = ', '.join('?' for _ in self._colnames)
+        first_rowid = None
+
+        for row in rows:
+            if row == self._colnames:
+                continue
+
+            cursor = self._connection.execute(f'INSERT INTO {self._table_name} VALUES ({placeholders})', [str(value) for value in row])
+            if first_rowid is None:
+                first_rowid = cursor.lastrowid
+
+        self._connection.execute('UPDATE tables SET version = version + 1 WHERE filename = ?', (self._filename,))
+        return first_rowid
+
+    def checkRows(self, data:list) -> list:
+        # Same rule as the csv files, so tables can be moved between the backends
+        rows = super().checkRows(data)
+
+        for row in rows:
+            line = ''.join(map(str, row))
+            if '\n' in line or '\r' in line:
+                raise ValueError(f"Line break in a value written to {self._filename}")
+
+        return rows
+
+    @timed('SQLiteTable.appendData')
+    def appendData(self, data:list) -> int:
+        # Returns rowid of the first row
+        offset = self._insertRows(self.checkRows(data))
+        self._connection.commit()
+        return offset
+
+    def openWriter(self, max_pending = 1, max_delay = 0.0, fsync = True) -> 'SQLiteWriter':
+        return SQLiteWriter(self, max_pending, max_delay)
+
+    def iterRows(self, columns = None, row_filter = None, get_header = False):
+        if not self._exists():
+            return
+
+        if get_header:
+            yield list(columns) if columns is not None else list(self._colnames)
+
+        if columns is not None:
+            column_indexes = [self._colnames.index(col) for col in columns]
+
+        for row in self._connection.execute(f'SELECT {self._column_list} FROM {self._table_name} ORDER BY rowid'):
+            row = list(row)
+
+            if row_filter is not None and not row_filter(row):
+                continue
+
+            if columns is not None:
+                row = [row[i] for i in column_indexes]
+
+            yield row
+
+    def iterRowsWithOffsets(self, offset = 0):
+        if not self._exists():
+            return
+
+        cursor = self._connection.execute(f'SELECT rowid, {self._column_list} FROM {self._table_name} WHERE rowid >= ? ORDER BY rowid', (offset,))
+        for row in cursor:
+            yield row[0], list(row[1:])
+
+    def getLastRow(self) -> list:
+        if not self._exists():
+            return None
+
+        row = self._connection.execute(f'SELECT {self._column_list} FROM {self._table_name} ORDER BY rowid DESC LIMIT 1').fetchone()
+        return list(row) if row is not None else None
+
+    @timed('SQLiteTable.overwriteFile')
+    def overwriteFile(self, new_data:list) -> None:
+        # One transaction, so a crash leaves either the old or the new rows
+        assert len(new_data) > 0
+        rows = self.checkRows(new_data)
+
+        if self._exists():
+            self._connection.execute(f'DELETE FROM {self._table_name}')
+        self._insertRows(rows)
+        self._connection.commit()
+
+    def getFileStamp(self) -> tuple:
+        row = self._connection.execute('SELECT version FROM tables WHERE filename = ?', (self._filename,)).fetchone()
+        if row is None:
+            return None
+
+        return (row[0],)
+
+
+class SQLiteWriter:
+    # Same use as CSVWriter: rows are inserted straight away but only
+    # committed (made durable) when max_pending appendData calls are waiting,
+    # the oldest is older than max_delay seconds (max_delay <= 0 means no
+    # time limit), or on flush()/close().
+    # A commit made by any other write on the same database commits them too.
+
+    def __init__(self, table:SQLiteTable, max_pending = 1, max_delay = 0.0):
+        self._table = table
+        self._max_pending = int(max_pending)
+        self._max_delay = float(max_delay)
+        self._pending = 0
+        self._first_pending_time = None
+
+    def appendData(self, data:list) -> int:
+        offset = self._table._insertRows(self._table.checkRows(data))
+
+        if self._pending == 0:
+            self._first_pending_time = time.monotonic()
+        self._pending += 1
+
+        if self._pending >= self._max_pending or 0 < self._max_delay <= time.monotonic() - self._first_pending_time:
+            self.flush()
+
+        return offset
+
+    def hasPending(self) -> bool:
+        return self._pending > 0
+
+    def flush(self) -> None:
+        if self._pending == 0:
+            return
+
+        self._table._connection.commit()
+        self._pending = 0
+        self._first_pending_time = None
+
+    def close(self) -> None:
+        self.flush()
@@ -0,0 +1,84 @@
+import csv
+import json
+import time
+from database import CSVdb
+from product import ProductService
+
+
+class PriceImporter:
+    # Reads a price/campaign feed and applies it to a ProductService with one write.
+    # Each row is a change as taken by ProductService.updateProducts:
+    # id, description, price, campaign_price, campaign_start, campaign_end.
+    # .jsonl files have one JSON object per line, other files are read as CSV
+    # with the same delimiter as CSVdb and a header naming the columns.
+    # Empty CSV cells are left out of the change.
+
+    def __init__(self, product_service:ProductService):
+        self._productService = product_service
+
+    def _iterFeed(self, filename:str):
+        # Yields (line number, change) one row at a time.
+        # Raises ValueError if the file is not text or not valid CSV.
+        try:
+            with open(filename, 'r', newline = '') as f:
+                if filename.endswith('.jsonl'):
+                    for line_nr, line in enumerate(f, start = 1):
+                        if line.strip() == '':
+                            continue
+                        try:
+                            yield line_nr, json.loads(line)
+                        except ValueError:
+                            yield line_nr, None
+                else:
+                    reader = csv.DictReader(f, delimiter = CSVdb.delimiter)
+                    for row in reader:
+                        change = {key: value for key, value in row.items() if value not in ('', None)}
+                        yield reader.line_num, change
+
+        except (UnicodeDecodeError, csv.Error) as error:
+            raise ValueError(f"Could not read {filename}: {error}")
+
+    def readFeed(self, filename:str) -> tuple:
+        # Returns (valid changes, rejected rows as (line number, reason)).
+        # Raises OSError or ValueError if the file can not be read.
+        changes = []
+        rejected = []
+
+        for line_nr, change in self._iterFeed(filename):
+            if type(change) != dict:
+                rejected.append((line_nr, 'Invalid row'))
+                continue
+
+            try:
+                self._productService.checkChange(change)
+            except ValueError as error:
+                rejected.append((line_nr, str(error)))
+                continue
+
+            changes.append(change)
+
+        return changes, rejected
+
+    def importFile(self, filename:str) -> dict:
+        start_time = time.perf_counter()
+
+        changes, rejected = self.readFeed(filename)
+        updated_rows = self._productService.updateProducts(changes)
+
+        return self.makeReport(changes, rejected, updated_rows, time.perf_counter() - start_time)
+
+    @staticmethod
+    def makeReport(changes:list, rejected:list, updated_rows:int, seconds:float) -> dict:
+        read_rows = len(changes) + len(rejected)
+        rows_per_second = read_rows / seconds if seconds > 0 else 0
+
+        return {'read_rows':read_rows, 'accepted_rows':len(changes), 'rejected':rejected,
+                'updated_rows':updated_rows, 'seconds':seconds, 'rows_per_second':rows_per_second}
+
+    @staticmethod
+    def printReport(report:dict) -> None:
+        print(f"Lästa rader: {report['read_rows']}, godkända: {report['accepted_rows']}, uppdaterade produkter: {report['updated_rows']}")
+        print(f"Tid: {round(report['seconds'], 3)} s ({round(report['rows_per_second'])} rader/s)")
+
+        for line_nr, reason in report['rejected']:
+            print(f"Rad {line_nr} avvisad: {reason}")
@@ -1,31 +1,44 @@
 from menu import ConsoleMenu, CheckoutMenu, AdminMenu
+from store import DataStore
+
+def kassan(product_filename = 'products.txt', backend = 'csv', shared = False, write_settings = None):
+    # backend: 'csv' for the text files or 'sqlite' for kassan.db
+    # shared: True when several lanes (kassan processes) run on the same files
+    # write_settings: group commit of receipts, see DataStore
+    # No files are read before the menu is shown, the services are built
+    # in the background while waiting for the first choice
+    store = DataStore(product_filename, backend, shared, write_settings)
+    store.preload()
+
+    main_menu_string = 'KASSA \n1. Ny Kund \n2. Admin \n0. Avsluta'
+    start_menu = ConsoleMenu(main_menu_string, 2)
+    admin_menu = None
 
-def kassan(product_filename = 'products.txt'):
     while True:
-        main_menu_string = 'KASSA \n1. Ny Kund \n2. Admin \n0. Avsluta'
-        start_menu = ConsoleMenu(main_menu_string, 2)
         start_menu.askOption()
-        
+
         option1 = start_menu.getCurrentOption()
 
         if option1 == '0':
             print('Shutting down...')
+            store.close()
             break
 
         elif option1 == '1':
-            checkout_menu = CheckoutMenu('KASSA', product_filename)
+            checkout_menu = CheckoutMenu('KASSA', store)
             checkout_menu.checkout()
             del checkout_menu
 
         elif option1 == '2':
+            if admin_menu is None:
+                admin_menu_text = 'ADMIN \n1. Ändra pris & namn \n2. Starta kampanj \n3. Hitta kvitton \n4. Bygg om kvittoindex \n5. Importera priser \n6. Visa kampanjer \n7. Försäljningsrapport \n8. Mätvärden \n0. Avsluta'
+                admin_menu = AdminMenu(admin_menu_text, 8, store)
+
             while True:
-                admin_menu_text = 'ADMIN \n1. Ändra pris & namn \n2. Starta kampanj \n3. Hitta kvitton \n0. Avsluta'
-                admin_menu = AdminMenu(admin_menu_text, 3, product_filename)
                 admin_menu.askOption()
                 option2 = admin_menu.excecuteFromOption()
 
                 if option2 == 'exit':
-                    del admin_menu
                     break
 
 kassan('products.txt')
@@ -33,5 +46,4 @@ kassan('products.txt')
 
 
 
-        
 
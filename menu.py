@@ -1,7 +1,9 @@
-from product import ProductService
-from receipt import ReceiptService
+# store, importer and report load the data modules, they are imported where
+# they are used so the main menu can be shown without them
 from categories import AdminMenuOption
+from metrics import metrics
 import datetime as dt
+import time
 
 class ConsoleMenu:
     def __init__(self, menu_string:str, max_option:int):
@@ -38,19 +40,18 @@ class ConsoleMenu:
             return False
 
 class CheckoutMenu(ConsoleMenu):
-    def __init__(self, menu_string:str, product_file):
+    def __init__(self, menu_string:str, store:'DataStore'):
         self._menu_string = str(menu_string)
-        self._productService = ProductService(product_file)
-        self._receiptService = ReceiptService(product_file)
+        self._productService = store.getProductService()
+        self._receiptService = store.getReceiptService()
 
     def checkout(self):
         new_receipt = self._receiptService.createNewReceipt()
 
-        while True:
-            self.printMenu()
-            print(f"KVITTO   {new_receipt.getDatetimeObject()}")
-            new_receipt.printMenuStrings()
+        self.printMenu()
+        print(f"KVITTO   {new_receipt.getDatetimeObject()}")
 
+        while True:
             option = input('Kommandon: \n<product id> <antal> \nPAY \nKommando: ')
             input_values = option.lower().split(' ')
 
@@ -68,7 +69,10 @@ class CheckoutMenu(ConsoleMenu):
                 prod = self._productService.findProduct(prod_id)
                 prod.setAmount(amount)
 
-                new_receipt.addProduct(prod)
+                # Only the changed line is printed, not the whole receipt again
+                line = new_receipt.addProduct(prod)
+                print(new_receipt.getLineString(line))
+                print(f"Total: {new_receipt.getTotal()}")
 
 
 
@@ -103,11 +107,14 @@ class AdminMenu(ConsoleMenu):
     # Starta kampanj
     # Hitta kvitton
     # Avsluta
-    def __init__(self, menu_string:str, max_option:int, product_file:str):
+    def __init__(self, menu_string:str, max_option:int, store:'DataStore'):
         super().__init__(menu_string, max_option)
         self._current_option = AdminMenuOption.reset
-        self._productService = ProductService(product_file)
-        self._receiptService = ReceiptService(product_file)
+        # The same menu is used the whole session, the services are fetched
+        # from the store for each option in case they have been rebuilt
+        self._store = store
+        self._productService = None
+        self._receiptService = None
 
     def askOption(self):
         while True:
@@ -129,12 +136,15 @@ class AdminMenu(ConsoleMenu):
 
     def excecuteFromOption(self):
         # TODO add Categories(?)
+        if self._current_option == AdminMenuOption.exit:
+            return 'exit'
+
+        self._productService = self._store.getProductService()
+        self._receiptService = self._store.getReceiptService()
+
         if self._current_option == AdminMenuOption.reset:
             pass
 
-        elif self._current_option == AdminMenuOption.exit:
-            return 'exit'
-
         elif self._current_option == AdminMenuOption.priceAndName:
             self.changePriceAndName()
 
@@ -144,6 +154,21 @@ class AdminMenu(ConsoleMenu):
         elif self._current_option == AdminMenuOption.manageReceipts:
             self.receiptManagement()
 
+        elif self._current_option == AdminMenuOption.rebuildIndex:
+            self.rebuildReceiptIndex()
+
+        elif self._current_option == AdminMenuOption.importFeed:
+            self.importPriceFeed()
+
+        elif self._current_option == AdminMenuOption.showCampaigns:
+            self.showCampaigns()
+
+        elif self._current_option == AdminMenuOption.salesReport:
+            self.salesReport()
+
+        elif self._current_option == AdminMenuOption.showMetrics:
+            self.showMetrics()
+
         self._current_option = AdminMenuOption.reset
         return None
 
@@ -186,10 +211,11 @@ class AdminMenu(ConsoleMenu):
                 print('DATETIME ERROR WARNING WARNING')
                 pass
 
-        if self._productService.startCampaignOnProduct(prod_id, new_campaign_price, campaign_start_date, campaign_end_date):
-            return True
-        else:
-            return False
+        change = {'id':prod_id, 'campaign_start':campaign_start_date, 'campaign_end':campaign_end_date}
+        if new_campaign_price != '':
+            change['campaign_price'] = new_campaign_price
+
+        return self.confirmAndUpdate([change])
 
     def changePriceAndName(self):
         while True:
@@ -219,9 +245,131 @@ class AdminMenu(ConsoleMenu):
                 except ValueError:
                     print('Ange giltigt pris')
 
-        self._productService.updateProductNamePrice(prod_id, new_description, new_price)
+        change = {'id':prod_id, 'description':new_description, 'price':new_price}
+        self.confirmAndUpdate([change])
         return
+
+    def confirmAndUpdate(self, changes:list) -> int:
+        # Returns number of rows written, 0 if nothing was written
+        try:
+            affected_rows = self._productService.countAffectedRows(changes)
+        except ValueError as error:
+            print(error)
+            return 0
+
+        if affected_rows > 0:
+            checker = input(f"Are you sure you sure you want to update the database? {affected_rows} row(s) affected (y/n)")
+        else:
+            checker = 'y'
+
+        if checker == 'y':
+            return self._productService.updateProducts(changes)
+        else:
+            return 0
+
+    def importPriceFeed(self):
+        print('Fil med priser/kampanjer (.csv eller .jsonl), [enter] för att gå tillbaka')
+        filename = input('> ')
+
+        if filename == '':
+            return False
+
+        from importer import PriceImporter
+        importer = PriceImporter(self._productService)
+        start_time = time.perf_counter()
+
+        try:
+            changes, rejected = importer.readFeed(filename)
+        except (OSError, ValueError) as error:
+            print(error)
+            return False
+
+        # The time spent waiting for the confirmation is not part of the report
+        seconds = time.perf_counter() - start_time
+        affected_rows = self._productService.countAffectedRows(changes)
+
+        if affected_rows > 0:
+            checker = input(f"Are you sure you sure you want to update the database? {affected_rows} row(s) affected (y/n)")
+        else:
+            checker = 'y'
+
+        updated_rows = 0
+        if checker == 'y':
+            start_time = time.perf_counter()
+            updated_rows = self._productService.updateProducts(changes)
+            seconds += time.perf_counter() - start_time
+
+        report = importer.makeReport(changes, rejected, updated_rows, seconds)
+        importer.printReport(report)
+        return True
     
+    def showCampaigns(self):
+        while True:
+            print('Vilket datum? (Format: yyyymmdd, [enter] för idag)')
+            date = input('> ')
+
+            if date == '':
+                date = 'today'
+
+            try:
+                products = self._productService.getProductsOnCampaign(date)
+                break
+            except ValueError:
+                print('Ange giltigt datum')
+
+        if len(products) == 0:
+            print('Inga kampanjer')
+
+        for prod in products:
+            print(f"{prod.getId()} {prod.getDescription()}: {prod.getActivePrice(date)} (ordinarie {prod.getPrice()})")
+
+        input('fortsätt > ')
+        return True
+
+    def salesReport(self):
+        while True:
+            print('Från vilket datum? (Format: yyyymmdd)')
+            start_date = input('> ')
+
+            print('Till vilket datum? (Format: yyyymmdd)')
+            end_date = input('> ')
+
+            try:
+                from report import ReportService
+                report = ReportService(self._receiptService).makeReport(start_date, end_date)
+                break
+            except ValueError:
+                print('Ange giltigt datum')
+
+        report.printReport()
+        input('fortsätt > ')
+        return True
+
+    def showMetrics(self):
+        if not metrics.isEnabled():
+            print('Mätning är avstängd (starta med KASSAN_METRICS=1 för att mäta från start)')
+            if input('Slå på mätning nu? (y/n) ') == 'y':
+                metrics.enable()
+            return True
+
+        metrics.printSummary()
+
+        print('Spara som json-fil? Ange filnamn, [enter] för att gå tillbaka')
+        filename = input('> ')
+        if filename != '':
+            try:
+                metrics.saveSnapshot(filename)
+                print(f'Sparat till {filename}')
+            except OSError as error:
+                print(error)
+
+        return True
+
+    def rebuildReceiptIndex(self):
+        indexed_receipts = self._receiptService.rebuildIndex()
+        print(f'Kvittoindex uppdaterat, {indexed_receipts} kvitton')
+        return True
+
     def receiptManagement(self):
         while True:
             receipt_dict = self._receiptService.getOldReceipts()
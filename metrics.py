@@ -0,0 +1,125 @@
+import functools
+import os
+import threading
+import time
+
+
+class Metrics:
+    # Call counts, latency histograms and bytes read/written per operation.
+    # Off by default, since it costs a little on every call. Turned on with
+    # enable() or by starting the program with KASSAN_METRICS=1.
+
+    # Upper limits of the histogram buckets in milliseconds, the last bucket
+    # takes everything slower
+    bucket_limits_ms = (0.1, 1, 10, 100, 1000)
+
+    def __init__(self, enabled = False):
+        self._enabled = enabled
+        self._lock = threading.Lock() # server lanes record from several threads
+        self._operations = {}
+
+    def enable(self):
+        self._enabled = True
+
+    def disable(self):
+        self._enabled = False
+
+    def isEnabled(self) -> bool:
+        return self._enabled
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def _getOperation(self, name:str) -> dict:
+        operation = self._operations.get(name)
+
+        if operation is None:
+            operation = {'calls':0, 'total_ms':0.0, 'max_ms':0.0, 'bytes_read':0, 'bytes_written':0,
+                         'buckets':[0] * (len(self.bucket_limits_ms) + 1)}
+            self._operations[name] = operation
+
+        return operation
+
+    def record(self, name:str, seconds:float):
+        milliseconds = seconds * 1000
+
+        with self._lock:
+            operation = self._getOperation(name)
+            operation['calls'] += 1
+            operation['total_ms'] += milliseconds
+            operation['max_ms'] = max(operation['max_ms'], milliseconds)
+
+            bucket = 0
+            while bucket < len(self.bucket_limits_ms) and milliseconds > self.bucket_limits_ms[bucket]:
+                bucket += 1
+            operation['buckets'][bucket] += 1
+
+    def addBytes(self, name:str, read = 0, written = 0):
+        # Does not count as a call, so it can be used where there is no
+        # single call to time (like a generator)
+        with self._lock:
+            operation = self._getOperation(name)
+            operation['bytes_read'] += read
+            operation['bytes_written'] += written
+
+    def getSnapshot(self) -> dict:
+        # Plain dicts and numbers, ready for json
+        bucket_names = [f"<={limit}" for limit in self.bucket_limits_ms] + [f">{self.bucket_limits_ms[-1]}"]
+        operations = {}
+
+        with self._lock:
+            for name, operation in sorted(self._operations.items()):
+                calls = operation['calls']
+                operations[name] = {'calls':calls, 'total_ms':operation['total_ms'],
+                                    'mean_ms':operation['total_ms'] / calls if calls > 0 else 0.0,
+                                    'max_ms':operation['max_ms'],
+                                    'bytes_read':operation['bytes_read'], 'bytes_written':operation['bytes_written'],
+                                    'histogram_ms':dict(zip(bucket_names, operation['buckets']))}
+
+        return {'enabled':self._enabled, 'time':time.time(), 'operations':operations}
+
+    def saveSnapshot(self, filename:str):
+        import json # only needed here, kept out of startup
+        with open(filename, 'w') as f:
+            json.dump(self.getSnapshot(), f, indent = 2)
+
+    def printSummary(self):
+        operations = self.getSnapshot()['operations']
+
+        if len(operations) == 0:
+            print('Inga mätvärden än')
+            return
+
+        for name, operation in operations.items():
+            if operation['calls'] == 0:
+                # Only bytes are counted for this one, see addBytes
+                print(f"{name}: läst {operation['bytes_read']} B, skrivet {operation['bytes_written']} B")
+                continue
+
+            print(f"{name}: {operation['calls']} anrop, medel {round(operation['mean_ms'], 3)} ms, "
+                  f"max {round(operation['max_ms'], 3)} ms, läst {operation['bytes_read']} B, skrivet {operation['bytes_written']} B")
+            print('    ' + ', '.join(f"{bucket}: {count}" for bucket, count in operation['histogram_ms'].items()))
+
+
+metrics = Metrics(enabled = os.environ.get('KASSAN_METRICS') == '1')
+
+
+def timed(name:str):
+    # Decorator that records the latency of every call under name when
+    # metrics are turned on
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.isEnabled():
+                return function(*args, **kwargs)
+
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.record(name, time.perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
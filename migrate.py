@@ -0,0 +1,43 @@
+import sys
+from database import CSVBackend, SQLiteBackend
+from product import ProductService
+from receipt import ReceiptService
+
+
+def migrateToSQLite(product_filename = 'products.txt', database_filename = 'kassan.db') -> dict:
+    # Copies the products, campaigns and all receipt files into a SQLite
+    # database and builds its serial number index. Tables already in the
+    # database are replaced. Returns filename -> number of rows copied.
+    source = CSVBackend()
+    target = SQLiteBackend(database_filename)
+    copied_rows = {}
+
+    tables = [(product_filename, ProductService._colnames), ('campaigns.txt', ProductService._campaign_colnames)]
+    for filename in source.getFilenames(contains = 'receipt_'):
+        if ReceiptService._filename_pattern.match(filename) is not None:
+            tables.append((filename, ReceiptService._colnames))
+
+    for filename, colnames in tables:
+        source_table = source.openTable(filename, colnames)
+
+        if source_table.getFileStamp() is None:
+            continue
+
+        rows = source_table.getData()
+        target.openTable(filename, colnames).overwriteFile([colnames] + rows)
+        copied_rows[filename] = len(rows)
+
+    receipt_service = ReceiptService(ProductService(product_filename, backend = target), target)
+    receipt_service.rebuildIndex()
+    receipt_service.close()
+    target.close()
+
+    return copied_rows
+
+
+if __name__ == '__main__':
+    # python migrate.py [products file] [database file]
+    copied_rows = migrateToSQLite(*sys.argv[1:3])
+
+    for filename, row_count in copied_rows.items():
+        print(f"{filename}: {row_count} rader")
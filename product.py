@@ -1,11 +1,20 @@
 import datetime as dt
+import math
+import re
 from categories import PriceType
-from database import CSVdb
-from copy import deepcopy
+from database import CSVBackend
+from campaign import CampaignSchedule, CampaignIndex, getCampaignEnd
+from metrics import timed
+from copy import copy
 
 class Product():
 
     datetime_format = '%Y%m%d'
+    # The campaign of a product without one. Campaign dicts and lists are never
+    # changed in place, only replaced, so products can share them.
+    _no_campaign = {'price':0, 'start_date':None, 'end_date':None, 'priority':0}
+
+    __slots__ = ('_id', '_description', '_price', '_price_type', '_amount', '_campaign', '_scheduled_campaigns', '_schedule')
     
     def __init__(self, id:str, description:str, price:float, price_type: PriceType, amount = 1):
         self._id = str(id)
@@ -14,41 +23,71 @@ class Product():
         self._price_type = price_type
         self._amount = float(amount)
 
-        self._campaign = {'price':0, 'start_date':None, 'end_date':None}
+        # The campaign stored in the product file, priority 0
+        self._campaign = self._no_campaign
+        # Extra campaigns from the campaign file
+        self._scheduled_campaigns = ()
+        self._schedule = None
+
 
+    def copy(self):
+        # Campaigns are only ever replaced, so a shallow copy is independent
+        return copy(self)
 
     def startCampaign(self, new_price:float, start = dt.datetime, end = dt.datetime):
-        campaign_data = {'price':new_price, 'start_date':start, 'end_date':end}
+        campaign_data = {'price':new_price, 'start_date':start, 'end_date':end, 'priority':0}
         self._campaign = campaign_data
+        self._schedule = None
 
-    def isCampaign(self, date = 'today') -> bool:
+    def addScheduledCampaign(self, price:float, start:dt.datetime, end:dt.datetime, priority = 0):
+        campaign_data = {'price':float(price), 'start_date':start, 'end_date':end, 'priority':int(priority)}
+        self._scheduled_campaigns = self._scheduled_campaigns + (campaign_data,)
+        self._schedule = None
+
+    def getCampaign(self) -> dict:
+        return self._campaign.copy()
+
+    def getCampaigns(self) -> list:
+        # All campaigns with dates, the product file campaign first
+        campaigns = []
+
+        if self._campaign['start_date'] is not None and self._campaign['end_date'] is not None:
+            campaigns.append(self._campaign)
+
+        return campaigns + list(self._scheduled_campaigns)
+
+    def getActiveCampaign(self, date = 'today') -> dict:
+        # date can be 'today', a yyyymmdd string or a datetime (the "price as of" time)
+
+        if self._campaign['start_date'] is None and len(self._scheduled_campaigns) == 0:
+            # No campaigns at all
+            return None
 
-        if date == 'today':
+        if isinstance(date, dt.datetime):
+            datetime_obj = date
+        elif date == 'today':
             datetime_obj = dt.datetime.today()
         else:
             datetime_obj = dt.datetime.strptime(date, self.datetime_format)
-        
-        try:
-            delta_start = self._campaign['start_date'] - datetime_obj
-            delta_end = self._campaign['end_date'] - datetime_obj
-        except TypeError:
-            # Dates are undefined, no campaign
-            return False
-        
-        if delta_start.days <= 0 and delta_end.days >= 0:
-            return True
-        else:
-            # Currently outside the campaign-window
-            return False
 
-    def calculatePrice(self) -> float:
-        active_price = self.getActivePrice()
+        if self._schedule is None:
+            self._schedule = CampaignSchedule(self.getCampaigns())
+
+        return self._schedule.getActiveCampaign(datetime_obj)
+
+    def isCampaign(self, date = 'today') -> bool:
+        return self.getActiveCampaign(date) is not None
+
+    def calculatePrice(self, price_time = 'today') -> float:
+        active_price = self.getActivePrice(price_time)
         
         return self.getAmount() * active_price
 
-    def getActivePrice(self) -> float:
-        if self.isCampaign():
-            return self._campaign['price']
+    def getActivePrice(self, price_time = 'today') -> float:
+        campaign = self.getActiveCampaign(price_time)
+
+        if campaign is not None:
+            return campaign['price']
         else:
             return self._price
 
@@ -79,6 +118,9 @@ class Product():
         else:
             return float(self._amount)
 
+    def getPriceType(self) -> PriceType:
+        return self._price_type
+
     def getPriceTypeString(self) -> str:
         if self._price_type == PriceType.weight:
             return 'w'
@@ -86,13 +128,13 @@ class Product():
             return 'q'
 
 
-    def getCampaignString(self) -> str:
-        if self.isCampaign():
+    def getCampaignString(self, price_time = 'today') -> str:
+        if self.isCampaign(price_time):
             return 'yes'
         else:
             return 'no'
 
-    def getRecieptInfo(self):
+    def getRecieptInfo(self, price_time = 'today'):
         #['serial_nr', 'time', 'product_id', 'product_description', 'amount', 'price', 'type', 'campaign']
 
         if self._price_type == PriceType.weight:
@@ -100,14 +142,14 @@ class Product():
         elif self._price_type == PriceType.quantity:
             amount_type = 'q'
 
-        is_campaign = 'yes' if self.isCampaign() else 'no'
+        campaign = self.getActiveCampaign(price_time)
+        active_price = campaign['price'] if campaign is not None else self._price
         
-        receipt_info = [self._id, self._description, str(self._amount), str(self.getActivePrice()), amount_type, is_campaign]
+        receipt_info = [self._id, self._description, str(self._amount), str(active_price), amount_type, 'yes' if campaign is not None else 'no']
         return receipt_info
     
-    def getInfoList(self, *args):
+    def getInfoList(self, *args, price_time = 'today'):
         data_list = []
-        all_data_dict = self.__dict__
 
         for attribute in args:
 
@@ -133,15 +175,15 @@ class Product():
                 data_list += campaign_info
 
             elif attribute == 'active_price':
-                data_list.append(str(self.getActivePrice()))
+                data_list.append(str(self.getActivePrice(price_time)))
             
             else:
 
                 try:   
-                    attribute_value = all_data_dict[key]
+                    attribute_value = getattr(self, key)
                     data_list.append(str(attribute_value))
 
-                except KeyError:
+                except AttributeError:
                     pass
 
         return data_list
@@ -152,19 +194,43 @@ class Product():
 
 class ProductService:
     _colnames = ['id', 'description', 'price', 'price_type', 'campaign_price', 'campaign_start', 'campaign_end']
+    _campaign_colnames = ['product_id', 'price', 'start', 'end', 'priority']
+    # Columns a change from the admin menu or a price feed may have
+    _change_colnames = ('id', 'description', 'price', 'campaign_price', 'campaign_start', 'campaign_end')
+    _control_characters = re.compile(r'[\x00-\x1f\x7f-\x9f]')
     datetime_format = '%Y%m%d'
 
-    def __init__(self, filename):
-        self.db = CSVdb(filename, self._colnames)
+    def __init__(self, filename, campaign_filename = 'campaigns.txt', backend = None):
+        if backend is None:
+            backend = CSVBackend()
+
+        self.db = backend.openTable(filename, self._colnames)
+        self._campaign_db = backend.openTable(campaign_filename, self._campaign_colnames)
+        self._saved_rows = [] # rows as they are in the file, same order as self._product_list
+        self._changed_indexes = set()
         self._product_list = self._getAllProducts()
+        self._product_index = self._buildIndex()
+        self._getScheduledCampaigns()
+        self._campaign_index = None
+        self._file_stamp = self.db.getFileStamp()
+        self._campaign_file_stamp = self._campaign_db.getFileStamp()
+
+    def isStale(self) -> bool:
+        if self._campaign_db.getFileStamp() != self._campaign_file_stamp:
+            return True
 
-    def _getAllProducts(self):
+        return self.db.getFileStamp() != self._file_stamp
 
-        product_data = self.db.getData()
+    def _buildIndex(self) -> dict:
+        # product id -> position in self._product_list
+        return {prod.getId(): i for i, prod in enumerate(self._product_list)}
+
+    def _getAllProducts(self):
 
         product_list = []
 
-        for row in product_data:
+        for row in self.db.iterRows():
+            self._saved_rows.append(row)
             data = self.db.convertToDataDict(row)
 
             type_weight = PriceType.weight if data['price_type'] == 'w' else PriceType.quantity
@@ -185,80 +251,218 @@ class ProductService:
         
         return product_list
 
+    @timed('ProductService.findProduct')
     def findProduct(self, product_id:str, get_index = False) -> Product:
 
-        for i, prod in enumerate(self._product_list):
-            if prod.getId() == product_id:
+        i = self._product_index.get(product_id)
 
-                if get_index:
-                    return deepcopy(prod), i
-                else:
-                    return deepcopy(prod)
+        if i is None:
+            if get_index:
+                return None, None
+            else:
+                return None
+
+        prod = self._product_list[i].copy()
 
         if get_index:
-            return None, None
+            return prod, i
         else:
-            return None
+            return prod
 
-    def updateDB(self):
-        old_data = self.db.getData(get_header=True)
-        new_data = [self._colnames]
+    def _getScheduledCampaigns(self):
+        if self._campaign_db.getFileStamp() is None:
+            return
 
-        assert old_data[0] == new_data[0]
-        
+        for row in self._campaign_db.iterRows():
+            data = self._campaign_db.convertToDataDict(row)
+            index = self._product_index.get(data['product_id'])
 
-        for prod in self._product_list:
-            new_data.append(prod.getInfoList('id', 'description', 'price', 'price_type', 'campaign_dict'))
+            if index is None:
+                continue
 
-        affected_rows = 0
-        for i, row in enumerate(new_data):
-            if row != old_data[i]:
-                affected_rows += 1
+            start = dt.datetime.strptime(data['start'], self.datetime_format)
+            end = dt.datetime.strptime(data['end'], self.datetime_format)
+            self._product_list[index].addScheduledCampaign(float(data['price']), start, end, int(data['priority']))
 
-        if affected_rows > 0:
-            checker = input(f"Are you sure you sure you want to update the database? {affected_rows} row(s) affected (y/n)")
-        else:
-            checker = 'y'
+    def addCampaign(self, product_id:str, price:float, start_date:str, end_date:str, priority = 0) -> bool:
+        # Schedules one more campaign for a product, next to any existing ones.
+        # When campaigns overlap the highest priority wins.
+        index = self._product_index.get(product_id)
+        if index is None:
+            return False
 
-        if checker == 'y':
-            self.db.overwriteFile(new_data)
-            return True
-        else:
+        try:
+            start_datetime = dt.datetime.strptime(start_date, self.datetime_format)
+            end_datetime = dt.datetime.strptime(end_date, self.datetime_format)
+            price = float(price)
+            priority = int(priority)
+        except (TypeError, ValueError):
             return False
 
+        if self._campaign_db.getFileStamp() is None:
+            self._campaign_db.appendData(self._campaign_colnames)
+        self._campaign_db.appendData([product_id, str(price), start_date, end_date, str(priority)])
+        self._campaign_file_stamp = self._campaign_db.getFileStamp()
 
-    def updateProductNamePrice(self, product_id:str, new_description='', new_price = 0):
-        old_products = self._product_list.copy()
-        prod, index = self.findProduct(product_id, get_index=True)
+        self._product_list[index].addScheduledCampaign(price, start_datetime, end_datetime, priority)
+        self._campaign_index = None
+        return True
 
-        if len(new_description) > 0:
-            prod.setDescription(new_description)
-        
-        if new_price > 0:
-            prod.setPrice(new_price)
+    def getProductsOnCampaign(self, date = 'today') -> list:
+        # Products with an active campaign on date ('today', yyyymmdd or datetime)
+        if isinstance(date, dt.datetime):
+            datetime_obj = date
+        elif date == 'today':
+            datetime_obj = dt.datetime.today()
+        else:
+            datetime_obj = dt.datetime.strptime(date, self.datetime_format)
 
-        self._product_list[index] = prod
+        if self._campaign_index is None:
+            intervals = []
+            for prod in self._product_list:
+                for campaign in prod.getCampaigns():
+                    intervals.append((campaign['start_date'], getCampaignEnd(campaign), prod.getId()))
+
+            self._campaign_index = CampaignIndex(intervals)
+
+        product_ids = sorted(self._campaign_index.query(datetime_obj))
+        return [self.findProduct(product_id) for product_id in product_ids]
+
+    @timed('ProductService.updateDB')
+    def updateDB(self) -> int:
+        # Writes products changed since the last write, returns number of rows written.
+        # Only changed products are compared with the file.
+        changed_rows = {}
+
+        for i in self._changed_indexes:
+            new_row = self._getRow(self._product_list[i])
+
+            if new_row != self._saved_rows[i]:
+                changed_rows[i] = new_row
+
+        if len(changed_rows) > 0:
+            for i, row in changed_rows.items():
+                self._saved_rows[i] = row
+
+            self.db.overwriteFile([self._colnames] + self._saved_rows)
+            self._file_stamp = self.db.getFileStamp()
+
+        self._changed_indexes = set()
+        return len(changed_rows)
+
+    def _getRow(self, prod:Product) -> list:
+        return prod.getInfoList('id', 'description', 'price', 'price_type', 'campaign_dict')
+
+    def _applyChanges(self, changes:list) -> dict:
+        # Applies changes to copies of the products and returns index -> changed copy.
+        # A change is a dict with 'id' and any of 'description', 'price',
+        # 'campaign_price', 'campaign_start' and 'campaign_end' (yyyymmdd).
+        # Empty description or price 0 means no change, like in the admin menu.
+        # Raises ValueError if any change is invalid: unknown columns, values
+        # that are not text or numbers, descriptions with control characters
+        # and prices that are negative or not finite.
+        changed_products = {}
+
+        for change in changes:
+            if 'id' not in change:
+                raise ValueError('Change without product id')
+
+            for column, value in change.items():
+                if column not in self._change_colnames:
+                    raise ValueError(f"Unknown column {column}")
+                # bool is a subclass of int, so the exact type is checked
+                if type(value) not in (str, int, float):
+                    raise ValueError(f"Invalid value in column {column} for product {change['id']}")
+
+            index = self._product_index.get(str(change['id']))
+            if index is None:
+                raise ValueError(f"Product {change['id']} does not exist")
+
+            if index not in changed_products:
+                changed_products[index] = self._product_list[index].copy()
+            prod = changed_products[index]
+
+            description = str(change.get('description', ''))
+            if self._control_characters.search(description) is not None:
+                # A line break would also split the row in the product and receipt files
+                raise ValueError(f"Description of product {change['id']} has line breaks or control characters")
+            if len(description) > 0:
+                prod.setDescription(description)
+
+            price = self._getChangePrice(change, 'price', 0)
+            if price > 0:
+                prod.setPrice(price)
+
+            if 'campaign_start' in change or 'campaign_end' in change or 'campaign_price' in change:
+                # Without a new campaign price the current one is kept, or the ordinary price if there is none
+                current_price = prod.getCampaign()['price']
+                if float(current_price) <= 0:
+                    current_price = prod.getPrice()
+                campaign_price = self._getChangePrice(change, 'campaign_price', current_price)
 
-        if self.updateDB():
-            return
-        else:
-            self._product_list = old_products
-            return
+                try:
+                    start_datetime = dt.datetime.strptime(change['campaign_start'], self.datetime_format)
+                    end_datetime = dt.datetime.strptime(change['campaign_end'], self.datetime_format)
+                except (KeyError, TypeError):
+                    raise ValueError(f"Campaign for product {change['id']} needs start and end date")
 
-    def startCampaignOnProduct(self, prod_id:str, new_price:float, start_date:str, end_date:str) -> bool:
+                prod.startCampaign(campaign_price, start_datetime, end_datetime)
+
+        return changed_products
 
-        prod, index = self.findProduct(prod_id, get_index = True)
+    @staticmethod
+    def _getChangePrice(change:dict, column:str, default) -> float:
         try:
-            start_datetime = dt.datetime.strptime(start_date, self.datetime_format)
-            end_datetime = dt.datetime.strptime(end_date, self.datetime_format)
-        except TypeError:
-            return False
-        if prod is None:
-            return False
+            price = float(change.get(column, default))
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {column} for product {change['id']}")
 
-        prod.startCampaign(new_price, start_datetime, end_datetime)
+        if not math.isfinite(price) or price < 0:
+            raise ValueError(f"Invalid {column} for product {change['id']}")
+
+        return price
+
+    def checkChange(self, change:dict) -> None:
+        # Raises ValueError if the change can not be applied
+        self._applyChanges([change])
+
+    def countAffectedRows(self, changes:list) -> int:
+        # Number of rows updateProducts would write, without changing anything
+        changed_products = self._applyChanges(changes)
+        affected_rows = 0
+
+        for index, prod in changed_products.items():
+            if self._getRow(prod) != self._saved_rows[index]:
+                affected_rows += 1
+
+        return affected_rows
+
+    def updateProducts(self, changes:list) -> int:
+        # Applies all changes with a single write, returns number of rows written.
+        # If any change is invalid a ValueError is raised and nothing is changed.
+        changed_products = self._applyChanges(changes)
+
+        for index, prod in changed_products.items():
+            self._product_list[index] = prod
+            self._changed_indexes.add(index)
+
+        self._campaign_index = None
+        return self.updateDB()
+
+    def updateProductNamePrice(self, product_id:str, new_description='', new_price = 0) -> bool:
+        try:
+            self.updateProducts([{'id':product_id, 'description':new_description, 'price':new_price}])
+        except ValueError:
+            return False
 
-        self._product_list[index] = prod
-        self.updateDB()
         return True
 
+    def startCampaignOnProduct(self, prod_id:str, new_price:float, start_date:str, end_date:str) -> bool:
+        change = {'id':prod_id, 'campaign_price':new_price, 'campaign_start':start_date, 'campaign_end':end_date}
+
+        try:
+            self.updateProducts([change])
+        except ValueError:
+            return False
+
+        return True
@@ -1,10 +1,81 @@
 from product import Product
 from product import ProductService
 import datetime as dt
-from database import CSVdb
+import re
+import sys
+from database import CSVdb, CSVBackend, SharedLock
+from contextlib import nullcontext
+from summary import DaySummary, DaySummaryCache, DayRowCache
 from categories import PriceType
-from copy import deepcopy
-
+from collections import OrderedDict
+from collections.abc import Mapping
+from metrics import timed
+
+
+class ReceiptLine():
+    # One line of a receipt as it was sold: product id, description, amount,
+    # unit price, price type and whether it was a campaign price.
+    # Immutable and without a __dict__, so loading a lot of old receipts stays
+    # small. Has the same getters as Product so receipts can use either.
+
+    __slots__ = ('_id', '_description', '_amount', '_unit_price', '_price_type', '_is_campaign')
+
+    def __init__(self, product_id:str, description:str, amount:float, unit_price:float, price_type:PriceType, is_campaign:bool):
+        # Descriptions repeat a lot, interning makes every line share one string
+        object.__setattr__(self, '_id', sys.intern(str(product_id)))
+        object.__setattr__(self, '_description', sys.intern(str(description)))
+        object.__setattr__(self, '_amount', float(amount))
+        object.__setattr__(self, '_unit_price', float(unit_price))
+        object.__setattr__(self, '_price_type', price_type)
+        object.__setattr__(self, '_is_campaign', bool(is_campaign))
+
+    @classmethod
+    def fromProduct(cls, product:Product, price_time = 'today'):
+        # Snapshot of what a receipt needs from a product at scan time.
+        # The campaign is looked up once, so later campaign changes do not
+        # affect a receipt that is already being built.
+        campaign = product.getActiveCampaign(price_time)
+        unit_price = campaign['price'] if campaign is not None else product.getPrice()
+        return cls(product.getId(), product.getDescription(), product.getAmount(), unit_price, product.getPriceType(), campaign is not None)
+
+    def withAmount(self, amount:float):
+        # Lines are immutable, a changed amount gives a new line
+        return ReceiptLine(self._id, self._description, amount, self._unit_price, self._price_type, self._is_campaign)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ReceiptLine is immutable')
+
+    def getId(self):
+        return self._id
+
+    def getDescription(self):
+        return self._description
+
+    def getAmount(self):
+        if self._price_type == PriceType.quantity:
+            return int(self._amount)
+        else:
+            return float(self._amount)
+
+    def getActivePrice(self, price_time = 'today') -> float:
+        # The price is the one the line was sold for, price_time does not change it
+        return self._unit_price
+
+    def calculatePrice(self, price_time = 'today') -> float:
+        return self.getAmount() * self._unit_price
+
+    def isCampaign(self, date = 'today') -> bool:
+        return self._is_campaign
+
+    def getPriceTypeString(self) -> str:
+        if self._price_type == PriceType.weight:
+            return 'w'
+        elif self._price_type == PriceType.quantity:
+            return 'q'
+
+    def getRecieptInfo(self, price_time = 'today'):
+        is_campaign = 'yes' if self._is_campaign else 'no'
+        return [self._id, self._description, str(self._amount), str(self._unit_price), self.getPriceTypeString(), is_campaign]
 
 class _Receipt():
 
@@ -16,19 +87,36 @@ class _Receipt():
         self._time_string = ''
         self._serial_number = ''
         self._products = []
-
-    def addProduct(self, product:Product):
-        independent_product = deepcopy(product)
-        assert type(independent_product) == Product
-        self._products.append(independent_product)
+        self._price_time = 'today' # campaigns are checked against this time
+        self._total = 0.0 # kept up to date as lines are added
+        self._line_index = {} # product id -> position in self._products
+
+    def addProduct(self, product:Product) -> ReceiptLine:
+        # Scanning a product that is already on the receipt adds to its line.
+        # Returns the line that was added or changed.
+        position = self._line_index.get(product.getId())
+
+        if position is not None:
+            old_line = self._products[position]
+            line = old_line.withAmount(old_line.getAmount() + product.getAmount())
+            self._products[position] = line
+            self._total += line.calculatePrice() - old_line.calculatePrice()
+            return line
+
+        # Only the fields the receipt needs are kept, no copy of the product
+        line = ReceiptLine.fromProduct(product, self._price_time)
+        self._line_index[line.getId()] = len(self._products)
+        self._products.append(line)
+        self._total += line.calculatePrice()
+        return line
+
+    def addLine(self, line:ReceiptLine):
+        # Lines read from file are kept as they were written, without merging
+        self._products.append(line)
+        self._total += line.calculatePrice(self._price_time)
 
     def getTotal(self) -> float:
-        total = 0
-
-        for product in self._products:
-            total += product.calculatePrice()
-
-        return total
+        return self._total
 
     def getTime(self):
         return self._time_string
@@ -43,22 +131,14 @@ class _Receipt():
             return data_list
         
         for product in self._products:
-
-            receipt_data = [self._serial_number, self._time_string]
-            
-            if product.isCampaign():
-                is_campaign_string = 'yes'
-            else:
-                is_campaign_string = 'no'
-
-            product_data = product.getInfoList('id', 'description', 'amount', 'active_price', 'price_type')
-
-            full_row = receipt_data + product_data + [is_campaign_string]
-            
-            data_list.append(full_row)
+            data_list.append(self.getLineRow(product))
 
         return data_list
 
+    def getLineRow(self, line) -> list:
+        # One line as a row in the receipt file
+        return [self._serial_number, self._time_string] + line.getRecieptInfo(self._price_time)
+
     def getProducts(self):
         return self._products
 
@@ -70,13 +150,16 @@ class _Receipt():
             return
         
         for prod in self._products:
-            print_string = f"{prod.getDescription()} {prod.getAmount()} * {prod.getActivePrice()} = {round(prod.calculatePrice(), 2)}"
-            print(print_string)
+            print(self.getLineString(prod))
             
         end_string = f"Total: {self.getTotal()}"
         print(end_string)
         return
 
+    def getLineString(self, line) -> str:
+        active_price = line.getActivePrice(self._price_time)
+        return f"{line.getDescription()} {line.getAmount()} * {active_price} = {round(line.getAmount() * active_price, 2)}"
+
     def getDatetimeObject(self) -> dt.datetime:
         datetime_string = self.getDate() + self.getTime()
         combo_datetime_format = self.datetime_format + self.time_format
@@ -87,10 +170,10 @@ class _Receipt():
 
 class OldReceipt(_Receipt):
     def __init__(self, serial_nr:str, date_string:str, time_string:str):
+        super().__init__()
         self._date_string = str(date_string)
         self._serial_number = str(serial_nr)
         self._time_string = str(time_string)
-        self._products = []
     
 class NewReceipt(_Receipt):
     def __init__(self, serial_nr:str):
@@ -99,113 +182,437 @@ class NewReceipt(_Receipt):
         self._setInfoAuto()
 
     def _setInfoAuto(self):
+        # All prices on the receipt are taken as of when it was created,
+        # so a checkout that crosses midnight keeps the same prices
         now = dt.datetime.now()
+        self._price_time = now
         self._time_string = dt.datetime.strftime(now, self.time_format)
         self._date_string = dt.datetime.strftime(now, self.datetime_format)
 
+class ReceiptHistory(Mapping):
+    # Behaves like a dict of date -> list of receipts, but a date's file is
+    # only parsed when that date is used. At most max_loaded_dates dates are
+    # kept in memory, the least recently used date is dropped first.
+
+    def __init__(self, loader, dates, max_loaded_dates:int):
+        self._loader = loader
+        self._dates = list(dates)
+        self._max_loaded_dates = int(max_loaded_dates)
+        self._loaded = OrderedDict()
+
+    def __getitem__(self, date:str) -> list:
+        if date in self._loaded:
+            self._loaded.move_to_end(date)
+            return self._loaded[date]
+
+        if date not in self._dates:
+            raise KeyError(date)
+
+        receipts = self._loader(date)
+        self._addLoaded(date, receipts)
+        return receipts
+
+    def __setitem__(self, date:str, receipts:list):
+        if date not in self._dates:
+            self._dates.append(date)
+
+        self._addLoaded(date, receipts)
+
+    def __contains__(self, date) -> bool:
+        return date in self._dates
+
+    def __iter__(self):
+        return iter(self._dates)
+
+    def __len__(self) -> int:
+        return len(self._dates)
+
+    def isLoaded(self, date:str) -> bool:
+        return date in self._loaded
+
+    def addDate(self, date:str):
+        # A date whose file will be parsed when it is used
+        if date not in self._dates:
+            self._dates.append(date)
+
+    def forget(self, date:str):
+        # Parses the date's file again the next time it is used
+        self._loaded.pop(date, None)
+
+    def _addLoaded(self, date:str, receipts:list):
+        self._loaded[date] = receipts
+        self._loaded.move_to_end(date)
+
+        while len(self._loaded) > self._max_loaded_dates:
+            self._loaded.popitem(last = False)
+
 class ReceiptService():
     _colnames = ['serial_nr', 'time', 'product_id', 'product_description', 'amount', 'price', 'type', 'campaign']
     datetime_format = '%Y%m%d'
     time_format = '%H:%M:%S'
-
-    def __init__(self, product_file:str):
+    max_loaded_dates = 31
+    _index_colnames = ['serial_nr', 'date', 'offset']
+    index_filename = 'serial_index.txt'
+    _filename_pattern = re.compile(r'^receipt_(\d{8})\.txt$')
+    # Group commit settings for the receipt files, see CSVWriter
+    receipts_per_write = 1
+    max_write_delay = 0.0
+    fsync_writes = True
+    lock_filename = 'receipt.lock'
+    counter_filename = 'serial_counter.txt'
+    _counter_colnames = ['last_serial_nr']
+
+    def __init__(self, product_service:ProductService, backend = None, shared = False,
+                 receipts_per_write = None, max_write_delay = None, fsync_writes = None):
+        if backend is None:
+            backend = CSVBackend()
+
+        # Group commit settings not given are taken from the class attributes.
+        # Shared lanes always write straight away and do not use them.
+        if receipts_per_write is not None:
+            self.receipts_per_write = receipts_per_write
+        if max_write_delay is not None:
+            self.max_write_delay = max_write_delay
+        if fsync_writes is not None:
+            self.fsync_writes = fsync_writes
+
+        self._backend = backend
+        # shared: several checkout lanes (threads or processes) use the same files
+        self._shared = shared
+        self._lock = SharedLock(self.lock_filename) if shared else None
+        self._counter_db = backend.openTable(self.counter_filename, self._counter_colnames)
         self._db = {} #requires multiple databases because data in different files        
         self._setDatabasesAuto()
+        self._index_db = backend.openTable(self.index_filename, self._index_colnames)
+        self._serial_index = None
+        # (offset, serial_nr) of the last index row read, None if not known
+        self._index_position = None
+        self._writers = {}
+        self._summaryCache = DaySummaryCache()
+        self._rowCache = DayRowCache()
         self._old_receipts = self.getReceiptsFromDb()
-        self._productService = ProductService(product_file)
+        self._productService = product_service
+        self._file_stamps = self._getFileStamps()
+        self._last_serial_nr = self._findLastSerialNr()
+
+    def _getFileStamps(self) -> dict:
+        return self._backend.getFileStamps(self._db)
+
+    def isStale(self) -> bool:
+        if self._shared:
+            # Other lanes write all the time, refresh() keeps up with them instead
+            return False
+
+        # New receipt files written by someone else also make the service stale
+        if len(self._getReceiptFilenames()) != len(self._db):
+            return True
+
+        return self._getFileStamps() != self._file_stamps
 
     def fileExists(self):
         pass
 
-    def _setDatabasesAuto(self):
-        filenames = CSVdb.getFilenames(contains = 'receipt_')
-        dates = [file_path.split('_')[1][:-4] for file_path in filenames]
+    def _getLock(self):
+        if self._shared:
+            return self._lock
+
+        return nullcontext()
+
+    def _refreshDatabases(self):
+        # Picks up receipt files created by other lanes
+        for date, filename in self._getReceiptFilenames().items():
+            if date not in self._db:
+                self._db[date] = self._backend.openTable(filename, self._colnames)
+                self._old_receipts.addDate(date)
+
+    def refresh(self):
+        # Only needed in shared mode: drops loaded days that other lanes may
+        # have added to since they were read, and reads their new index rows
+        if not self._shared:
+            return
+
+        with self._lock:
+            self._refreshDatabases()
+
+            for date, stamp in self._getFileStamps().items():
+                if stamp != self._file_stamps.get(date):
+                    self._old_receipts.forget(date)
+                    self._file_stamps[date] = stamp
+
+            if self._serial_index is not None and not self._readNewIndexRows():
+                self._serial_index = None
+
+    def _getWriter(self, date:str):
+        if date not in self._writers:
+            self._writers[date] = self._db[date].openWriter(self.receipts_per_write, self.max_write_delay, self.fsync_writes)
+
+        return self._writers[date]
+
+    def _flushDate(self, date:str):
+        # Receipts waiting in a writer have to be on disk before the file is read
+        writer = self._writers.get(date)
+
+        if writer is not None and writer.hasPending():
+            writer.flush()
+            self._file_stamps[date] = self._db[date].getFileStamp()
+
+    def flush(self):
+        for date in self._writers.keys():
+            self._flushDate(date)
+
+    def close(self):
+        self.flush()
+
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
 
-        for i, date in enumerate(dates):
-            self._db[date] = CSVdb(filenames[i], self._colnames)
+    def _getReceiptFilenames(self) -> dict:
+        # date -> filename, only receipt_yyyymmdd.txt files
+        filenames = self._backend.getFilenames(contains = 'receipt_')
+        matches = [self._filename_pattern.match(filename) for filename in filenames]
+        return {match.group(1): match.group(0) for match in matches if match is not None}
+
+    def _setDatabasesAuto(self):
+        for date, filename in self._getReceiptFilenames().items():
+            self._db[date] = self._backend.openTable(filename, self._colnames)
 
     def getDatabases(self) -> dict:
         return self._db
 
-    # TODO Kinda mixed responsabillities - maybe split into multiple functions
-    def getReceiptsFromDb(self) -> dict:
-        db_dict = self.getDatabases()
-        receipt_dict = {}
-
-        for date in db_dict.keys():
-            data = db_dict[date].getData()
-
-            if len(data) == 0:
-                continue
-
-            receipt_dict[date] = []
-            last_serial_nr = data[0][0]
-            old_receipt = OldReceipt(last_serial_nr, date, data[0][1])
-
-            for row in data:
-                data_dict = db_dict[date].convertToDataDict(row)
-                current_serial_nr = data_dict['serial_nr']
-                type_weight = PriceType.weight if data_dict['type'] == 'w' else PriceType.quantity
-                prod = Product(data_dict['product_id'], data_dict['product_description'], data_dict['price'], type_weight, data_dict['amount'] )
-                
-                if row == data[-1]: #special case for last iteration (only works if all rows are unique) possible bug
-                    old_receipt.addProduct(prod)
-                    receipt_dict[date].append(old_receipt)
-
-                elif last_serial_nr != current_serial_nr:
-                    receipt_dict[date].append(old_receipt)
-                    old_receipt = OldReceipt(data_dict['serial_nr'], date, data_dict['time'])
-                    old_receipt.addProduct(prod)
-
-                else: 
-                    old_receipt.addProduct(prod)
-                
-                last_serial_nr = current_serial_nr
-                
-        return receipt_dict
+    @timed('ReceiptService.getReceiptsFromDb')
+    def getReceiptsFromDb(self) -> 'ReceiptHistory':
+        return ReceiptHistory(self._getReceiptsFromDate, self._db.keys(), self.max_loaded_dates)
+
+    @timed('ReceiptService.loadDate')
+    def _getReceiptsFromDate(self, date:str) -> list:
+        self._flushDate(date)
+        db = self._db[date]
+
+        # Closed days come already split from the row cache
+        closed = self._isClosedDate(date)
+
+        try:
+            return self._rowsToReceipts(db, date, self._rowCache.getRows(date, db, closed))
+        except (TypeError, ValueError):
+            if not closed:
+                raise
+            # Values in the cache file that are not what the receipt file has
+            return self._rowsToReceipts(db, date, self._rowCache.getRows(date, db, closed, rebuild = True))
+
+    def _isClosedDate(self, date:str) -> bool:
+        # A day that is over does not get any more receipts
+        today = dt.datetime.strftime(dt.datetime.now(), self.datetime_format)
+        return date < today
+
+    def getDaySummary(self, date:str) -> DaySummary:
+        self._flushDate(date)
+        return self._summaryCache.getSummary(date, self._db[date], self._isClosedDate(date))
+
+    def _rowsToReceipts(self, db:CSVdb, date:str, rows) -> list:
+        receipts = []
+        old_receipt = None
+
+        for row in rows:
+            data_dict = db.convertToDataDict(row)
+            serial_nr = data_dict['serial_nr']
+
+            if old_receipt is None or old_receipt.getSerialNr() != serial_nr:
+                old_receipt = OldReceipt(serial_nr, date, data_dict['time'])
+                receipts.append(old_receipt)
+
+            type_weight = PriceType.weight if data_dict['type'] == 'w' else PriceType.quantity
+            line = ReceiptLine(data_dict['product_id'], data_dict['product_description'], data_dict['amount'], data_dict['price'], type_weight, data_dict['campaign'] == 'yes')
+            old_receipt.addLine(line)
+
+        return receipts
 
+    @timed('ReceiptService.addNewReceipt')
     def addNewReceipt(self, receipt:NewReceipt):
         assert type(receipt) == NewReceipt
 
+        with self._getLock():
+            self._addNewReceipt(receipt)
+
+    def _addNewReceipt(self, receipt:NewReceipt):
         date = receipt.getDate()
 
-        try:
-            db = self._db[date]
+        if self._shared:
+            self._refreshDatabases()
 
-        except KeyError:
+        if date not in self._db:
             # No db from this date exists
             # New DB class has to be created
-            self._db[date] = CSVdb(f"receipt_{date}.txt", self._colnames)
-            self._db[date].appendData(self._colnames)
-            db = self._db[date]
+            self._db[date] = self._backend.openTable(f"receipt_{date}.txt", self._colnames)
             self._old_receipts[date] = []
 
-        db.appendData(receipt.getDataList())
-        self._old_receipts[date].append(receipt)
+        db = self._db[date]
+        if db.getFileStamp() is None:
+            db.appendData(self._colnames)
+
+        # Index has to be loaded (or rebuilt) before the new rows are written
+        self._getSerialIndex()
+
+        if self._shared:
+            # Other lanes append to the same file, so the rows are written
+            # straight away, at the end of the file as it is now
+            offset = db.appendData(receipt.getDataList())
+        else:
+            offset = self._getWriter(date).appendData(receipt.getDataList())
+
+        self._addToIndex(receipt.getSerialNr(), date, offset)
+        self._last_serial_nr = max(self._last_serial_nr, int(receipt.getSerialNr()))
+        if self._old_receipts.isLoaded(date):
+            # Otherwise the receipt is read from the file when the date is used
+            self._old_receipts[date].append(receipt)
+        # Also while rows are buffered: a CSV file is then unchanged, and SQLite
+        # rows are visible (and counted in the version) before the commit
+        self._file_stamps[date] = db.getFileStamp()
 
     def getLastSerialNr(self) -> int:
-        dates = list(self._old_receipts.keys())
-        sorted_dates = sorted(dates)
-        last_date = sorted_dates[-1]
+        return self._last_serial_nr
+
+    def _findLastSerialNr(self) -> int:
+        # The highest of the last row in the receipt files and the counter
+        # file. Shared lanes reserve numbers in order but pay in any order,
+        # so the last row is not always the highest number given out.
+        last_serial_nr = 0
 
-        last_receipt_data = self._db[last_date].getData()
+        for date in sorted(self._db.keys(), reverse = True):
+            last_row = self._db[date].getLastRow()
+
+            if last_row is not None:
+                last_serial_nr = int(last_row[0])
+                break
+
+        counter_row = self._counter_db.getLastRow()
+        if counter_row is not None:
+            last_serial_nr = max(last_serial_nr, int(counter_row[0]))
 
-        last_serial_nr = int(last_receipt_data[-1][0])
         return last_serial_nr
 
     def createNewReceipt(self) -> NewReceipt:
-        serial_nr = str(self.getLastSerialNr() + 1)
+        if self._shared:
+            with self._lock:
+                serial_nr = str(self._reserveSerialNr())
+        else:
+            serial_nr = str(self.getLastSerialNr() + 1)
+
         new_receipt = NewReceipt(serial_nr)
         return new_receipt
 
+    def _reserveSerialNr(self) -> int:
+        # Called with the lock held. The number is saved in the counter file
+        # before it is used, so no other lane can get it, even if this receipt
+        # is never paid.
+        self._refreshDatabases()
+        serial_nr = self._findLastSerialNr() + 1
+        self._counter_db.overwriteFile([self._counter_colnames, [str(serial_nr)]])
+        return serial_nr
+
     def getReceiptDates(self) -> list:        
+        self.refresh()
         return list(self._old_receipts.keys())
 
     def getOldReceipts(self) -> list:
+        self.refresh()
         return self._old_receipts
 
 
+    def _getSerialIndex(self) -> dict:
+        # serial_nr -> (date, byte offset of the receipt's first row)
+        if self._serial_index is None:
+            if self._index_db.getFileStamp() is None:
+                self.rebuildIndex()
+            else:
+                self._serial_index = {}
+                self._addIndexRows(self._index_db.iterRowsWithOffsets())
+
+        return self._serial_index
+
+    def _addIndexRows(self, rows):
+        # rows: (offset, row) from the index file
+        for offset, (serial_nr, date, receipt_offset) in rows:
+            self._serial_index[serial_nr] = (date, int(receipt_offset))
+            self._index_position = (offset, serial_nr)
+
+    def _readNewIndexRows(self) -> bool:
+        # Reads the index rows written after the last one read, by this or
+        # other lanes. Returns False if the index has to be read from the
+        # start: the last row read is not where it was, because the file has
+        # been rewritten (rebuildIndex), or it is not known.
+        if self._index_position is None:
+            return False
+
+        last_offset, last_serial_nr = self._index_position
+        rows = self._index_db.iterRowsWithOffsets(last_offset)
+        first = next(rows, None)
+
+        if first is None or first[0] != last_offset or first[1][0] != last_serial_nr:
+            return False
+
+        self._addIndexRows(rows)
+        return True
+
+    def _addToIndex(self, serial_nr:str, date:str, offset:int):
+        self._serial_index[serial_nr] = (date, offset)
+        self._index_db.appendData([serial_nr, date, str(offset)])
+
+    def rebuildIndex(self) -> int:
+        # Recreates the serial number index from the receipt files
+        index_data = [self._index_colnames]
+        self._serial_index = {}
+        self._index_position = None
+        self.flush()
+
+        for date in sorted(self._db.keys()):
+            last_serial_nr = None
+
+            for offset, row in self._db[date].iterRowsWithOffsets():
+                serial_nr = row[0]
+
+                if serial_nr != last_serial_nr:
+                    self._serial_index[serial_nr] = (date, offset)
+                    index_data.append([serial_nr, date, str(offset)])
+                    last_serial_nr = serial_nr
+
+        self._index_db.overwriteFile(index_data)
+        return len(index_data) - 1
+
+    def _findIndexedReceipt(self, serial_nr:str) -> OldReceipt:
+        try:
+            date, offset = self._getSerialIndex()[serial_nr]
+            db = self._db[date]
+        except KeyError:
+            return None
+
+        self._flushDate(date)
+        rows = []
+        for _, row in db.iterRowsWithOffsets(offset):
+            if row[0] != serial_nr:
+                break
+            rows.append(row)
+
+        receipts = self._rowsToReceipts(db, date, rows)
+
+        if len(receipts) == 0:
+            # Index is out of date with the file
+            return None
+
+        return receipts[0]
+
     def findReceipt(self, serial_nr:str) -> OldReceipt:
+        self.refresh()
+
+        with self._getLock():
+            return self._findReceipt(serial_nr)
+
+    def _findReceipt(self, serial_nr:str) -> OldReceipt:
+        receipt = self._findIndexedReceipt(serial_nr)
+
+        if receipt is not None:
+            return receipt
+
         for date in self._old_receipts.keys():
 
             receipt_from_date = self._old_receipts[date]
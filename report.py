@@ -0,0 +1,147 @@
+import datetime as dt
+from receipt import ReceiptService
+from summary import DaySummary
+
+
+class SalesReport:
+    # Sales figures for all receipt files from start_date to end_date (yyyymmdd, both included)
+
+    def __init__(self, start_date:str, end_date:str):
+        self._start_date = start_date
+        self._end_date = end_date
+        self._dates = []
+        self._revenue_per_date = {}
+        self._revenue_per_week = {}
+        # product id -> [description, units, revenue, campaign units, campaign revenue,
+        #                days sold on campaign, units sold on those days]
+        self._products = {}
+        self._receipt_count = 0
+        self._line_count = 0
+        self._unit_count = 0.0
+
+    def addDaySummary(self, summary:DaySummary):
+        date = summary.getDate()
+        week = self.getWeek(date)
+
+        self._dates.append(date)
+        self._revenue_per_date[date] = summary.getRevenue()
+        self._revenue_per_week[week] = self._revenue_per_week.get(week, 0.0) + summary.getRevenue()
+
+        products = self._products
+
+        # Runs once for every product of every day, so it is kept short
+        for product_id, (description, units, revenue, campaign_units, campaign_revenue) in summary.getProducts().items():
+            product = products.get(product_id)
+            if product is None:
+                product = [description, 0.0, 0.0, 0.0, 0.0, 0, 0.0]
+                products[product_id] = product
+
+            product[1] += units
+            product[2] += revenue
+            product[3] += campaign_units
+            product[4] += campaign_revenue
+
+            if campaign_units > 0:
+                product[5] += 1
+                product[6] += units
+
+        self._receipt_count += summary.getReceiptCount()
+        self._line_count += summary.getLineCount()
+        self._unit_count += summary.getUnitCount()
+
+    @staticmethod
+    def getWeek(date:str) -> str:
+        year, week, _ = dt.datetime.strptime(date, ReceiptService.datetime_format).isocalendar()
+        return f"{year}-W{week:02d}"
+
+    def getRevenuePerDate(self) -> dict:
+        return self._revenue_per_date
+
+    def getRevenuePerWeek(self) -> dict:
+        return self._revenue_per_week
+
+    def getTotalRevenue(self) -> float:
+        return sum(self._revenue_per_date.values())
+
+    def getProducts(self) -> dict:
+        # product id -> {'description', 'units', 'revenue', 'campaign_units', 'campaign_revenue'}
+        return {product_id: {'description':product[0], 'units':product[1], 'revenue':product[2],
+                             'campaign_units':product[3], 'campaign_revenue':product[4]}
+                for product_id, product in self._products.items()}
+
+    def getCampaignUplift(self, product_id:str) -> float:
+        # Average units per day on days the product sold on campaign compared to
+        # the other days in the report (days without sales count as 0).
+        # None if the product had no campaign days or no ordinary days.
+        product = self._products.get(product_id)
+        if product is None:
+            return None
+
+        campaign_day_count = product[5]
+        ordinary_day_count = len(self._dates) - campaign_day_count
+        ordinary_units = product[1] - product[6]
+
+        if campaign_day_count == 0 or ordinary_day_count == 0 or ordinary_units == 0:
+            return None
+
+        campaign_average = product[6] / campaign_day_count
+        ordinary_average = ordinary_units / ordinary_day_count
+        return campaign_average / ordinary_average - 1
+
+    def getBasketSize(self) -> dict:
+        if self._receipt_count == 0:
+            return {'receipts':0, 'lines':0.0, 'units':0.0, 'revenue':0.0}
+
+        return {'receipts':self._receipt_count,
+                'lines':self._line_count / self._receipt_count,
+                'units':self._unit_count / self._receipt_count,
+                'revenue':self.getTotalRevenue() / self._receipt_count}
+
+    def printReport(self) -> None:
+        print(f"RAPPORT {self._start_date} - {self._end_date}")
+        print(f"Total: {round(self.getTotalRevenue(), 2)}")
+
+        print('Per dag:')
+        for date, revenue in self._revenue_per_date.items():
+            print(f"{date}: {round(revenue, 2)}")
+
+        print('Per vecka:')
+        for week, revenue in self._revenue_per_week.items():
+            print(f"{week}: {round(revenue, 2)}")
+
+        print('Per produkt:')
+        sorted_products = sorted(self.getProducts().items(), key = lambda item: item[1]['revenue'], reverse = True)
+        for product_id, product in sorted_products:
+            print_string = f"{product_id} {product['description']}: {round(product['units'], 2)} st/kg, {round(product['revenue'], 2)}"
+
+            uplift = self.getCampaignUplift(product_id)
+            if uplift is not None:
+                print_string += f", kampanjeffekt {round(uplift * 100)}%"
+            print(print_string)
+
+        basket = self.getBasketSize()
+        print(f"Kvitton: {basket['receipts']}, per kvitto: {round(basket['lines'], 2)} rader, {round(basket['units'], 2)} st/kg, {round(basket['revenue'], 2)}")
+
+
+class ReportService:
+    # Builds SalesReports from the day summaries of the receipt service, so
+    # closed days come from the summary cache and only today's file is read
+
+    def __init__(self, receipt_service:ReceiptService):
+        self._receiptService = receipt_service
+
+    def makeReport(self, start_date:str, end_date:str) -> SalesReport:
+        # Raises ValueError if the dates are not yyyymmdd
+        dt.datetime.strptime(start_date, ReceiptService.datetime_format)
+        dt.datetime.strptime(end_date, ReceiptService.datetime_format)
+
+        report = SalesReport(start_date, end_date)
+
+        for date in sorted(self._receiptService.getDatabases().keys()):
+            # yyyymmdd strings sort like the dates they are
+            if date < start_date or date > end_date:
+                continue
+
+            report.addDaySummary(self._receiptService.getDaySummary(date))
+
+        return report
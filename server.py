@@ -0,0 +1,196 @@
+import asyncio
+import json
+import math
+import sys
+import time
+from collections import OrderedDict
+from itertools import count
+from categories import PriceType
+from store import DataStore
+from database import makeBackend
+from metrics import metrics
+
+
+class CheckoutServer:
+    # Runs the register logic behind a local socket so scanners and several
+    # terminals can use it at the same time. The protocol is one JSON object
+    # per line in each direction:
+    #   {"op": "start"}                                   -> {"session": 1, "serial_nr": "31"}
+    #   {"op": "scan", "session": 1, "product_id": "1111", "amount": 2}
+    #                                                     -> {"line": [...], "total": 25.0}
+    #   {"op": "pay", "session": 1}                       -> {"serial_nr": "31", "total": 25.0}
+    #   {"op": "receipt", "serial_nr": "31"}              -> {"lines": [...], "total": 25.0}
+    #   {"op": "metrics"}                                 -> snapshot, see metrics.Metrics
+    # Errors are answered with {"error": "..."}.
+    # File work (paying, looking up receipts) runs in worker threads, so the
+    # receipt service is used in shared mode.
+    # A session without requests for session_timeout seconds is dropped, its
+    # serial number is then skipped like for a receipt that is never paid.
+
+    session_timeout = 30 * 60
+
+    def __init__(self, product_filename = 'products.txt', backend = 'csv'):
+        self._store = DataStore(product_filename, makeBackend(backend), shared = True)
+        self._productService = self._store.getProductService()
+        self._receiptService = self._store.getReceiptService()
+        # session id -> [receipt, time of the last request], least recently used first
+        self._sessions = OrderedDict()
+        self._session_ids = count(1)
+
+    async def serve(self, host = '127.0.0.1', port = 8765):
+        server = await asyncio.start_server(self._handleClient, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handleClient(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b'':
+                    break
+
+                try:
+                    response = await self.handleRequest(json.loads(line))
+                except Exception as error:
+                    # Also errors from writing the files, a failed request
+                    # must not end the connection
+                    response = {'error':str(error)}
+
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def handleRequest(self, request:dict) -> dict:
+        op = request['op']
+        loop = asyncio.get_running_loop()
+        self._expireSessions()
+
+        if op == 'start':
+            receipt = await loop.run_in_executor(None, self._receiptService.createNewReceipt)
+            session_id = next(self._session_ids)
+            self._sessions[session_id] = [receipt, time.monotonic()]
+            return {'session':session_id, 'serial_nr':receipt.getSerialNr()}
+
+        elif op == 'scan':
+            receipt = self._getSession(request)
+            amount = float(request['amount'])
+            prod = self._productService.findProduct(str(request['product_id']))
+
+            if prod is None:
+                raise ValueError(f"Product {request['product_id']} does not exist")
+            if not math.isfinite(amount) or amount <= 0:
+                raise ValueError('Amount has to be a finite number more than 0')
+            if prod.getPriceType() == PriceType.quantity and not amount.is_integer():
+                raise ValueError(f"Amount of {request['product_id']} has to be a whole number")
+
+            prod.setAmount(amount)
+            line = receipt.addProduct(prod)
+            return {'line':receipt.getLineRow(line), 'total':receipt.getTotal()}
+
+        elif op == 'pay':
+            receipt = self._getSession(request)
+            # Taken out while it is written, so it can not be paid twice at
+            # the same time, and put back if the write fails
+            session = self._sessions.pop(request['session'])
+
+            try:
+                if len(receipt.getProducts()) > 0:
+                    await loop.run_in_executor(None, self._receiptService.addNewReceipt, receipt)
+            except Exception:
+                self._sessions[request['session']] = session
+                raise
+
+            return {'serial_nr':receipt.getSerialNr(), 'total':receipt.getTotal()}
+
+        elif op == 'receipt':
+            receipt = await loop.run_in_executor(None, self._receiptService.findReceipt, str(request['serial_nr']))
+
+            if receipt is None:
+                raise ValueError(f"Receipt {request['serial_nr']} does not exist")
+
+            return {'lines':receipt.getDataList(), 'total':receipt.getTotal()}
+
+        elif op == 'metrics':
+            return metrics.getSnapshot()
+
+        else:
+            raise ValueError(f"Unknown op {op}")
+
+    def _getSession(self, request:dict):
+        session = self._sessions.get(request['session'])
+
+        if session is None:
+            raise ValueError(f"Unknown session {request['session']}")
+
+        session[1] = time.monotonic()
+        self._sessions.move_to_end(request['session'])
+        return session[0]
+
+    def _expireSessions(self):
+        # The least recently used sessions are first, so only expired ones are looked at
+        expire_time = time.monotonic() - self.session_timeout
+
+        while len(self._sessions) > 0:
+            session_id, (receipt, last_used) = next(iter(self._sessions.items()))
+            if last_used > expire_time:
+                break
+
+            del self._sessions[session_id]
+
+    def close(self):
+        self._store.close()
+
+
+async def _runSession(host:str, port:int, product_ids:list, scans:int, latencies:list):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def call(request:dict) -> dict:
+        start_time = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start_time)
+        return response
+
+    session_id = (await call({'op':'start'}))['session']
+    for i in range(scans):
+        await call({'op':'scan', 'session':session_id, 'product_id':product_ids[i % len(product_ids)], 'amount':1})
+    await call({'op':'pay', 'session':session_id})
+
+    writer.close()
+    await writer.wait_closed()
+
+
+async def runLoadTest(sessions = 50, scans = 20, product_ids = ('1111', '2222', '3333'), host = '127.0.0.1', port = 8765) -> dict:
+    # Runs sessions concurrent customers against a running server.
+    # Returns request count, requests per second and p50/p99 latency in ms.
+    latencies = []
+    start_time = time.perf_counter()
+
+    await asyncio.gather(*[_runSession(host, port, list(product_ids), scans, latencies) for _ in range(sessions)])
+
+    seconds = time.perf_counter() - start_time
+    latencies.sort()
+
+    return {'requests':len(latencies), 'requests_per_second':len(latencies) / seconds,
+            'p50_ms':latencies[len(latencies) // 2] * 1000,
+            'p99_ms':latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000}
+
+
+if __name__ == '__main__':
+    # python server.py                        starts the server
+    # python server.py loadtest [sessions] [scans]  runs the load test client
+    if len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+        result = asyncio.run(runLoadTest(*[int(arg) for arg in sys.argv[2:4]]))
+        print(f"{result['requests']} anrop, {round(result['requests_per_second'])} anrop/s, "
+              f"p50 {round(result['p50_ms'], 2)} ms, p99 {round(result['p99_ms'], 2)} ms")
+    else:
+        checkout_server = CheckoutServer()
+        try:
+            asyncio.run(checkout_server.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            checkout_server.close()
@@ -0,0 +1,74 @@
+import threading
+
+# product, receipt and database are imported on first use, so a DataStore
+# can be made (and the main menu shown) before the data modules are loaded
+
+
+class DataStore:
+    # Holds one ProductService and one ReceiptService for the whole program.
+    # The services are only rebuilt when their files have been changed on disk
+    # by someone else, so a new customer does not re-read every file.
+
+    def __init__(self, product_filename:str, backend = None, shared = False, write_settings = None):
+        # backend: a backend object, or a name for makeBackend ('csv', 'sqlite').
+        # A name is only turned into a backend when a service is first needed.
+        self._product_filename = product_filename
+        self._backend = backend
+        # shared: other checkout lanes use the same files, see ReceiptService
+        self._shared = shared
+        # write_settings: receipts_per_write, max_write_delay and fsync_writes
+        # for the ReceiptService, e.g. {'receipts_per_write':10, 'max_write_delay':1.0}
+        self._write_settings = write_settings or {}
+        self._productService = None
+        self._receiptService = None
+        # preload() builds the services in another thread
+        self._lock = threading.RLock()
+
+    def _getBackend(self):
+        if self._backend is None or type(self._backend) == str:
+            from database import makeBackend
+            self._backend = makeBackend(self._backend or 'csv')
+
+        return self._backend
+
+    def preload(self) -> threading.Thread:
+        # Builds both services in the background, so the first customer does
+        # not have to wait for all files to be read
+        def load():
+            try:
+                self.getReceiptService()
+            except Exception:
+                # The same error comes back when the service is first used
+                pass
+
+        thread = threading.Thread(target = load, daemon = True)
+        thread.start()
+        return thread
+
+    def getProductService(self) -> 'ProductService':
+        with self._lock:
+            if self._productService is None or self._productService.isStale():
+                from product import ProductService
+                self._productService = ProductService(self._product_filename, backend = self._getBackend())
+                self.close()
+
+            return self._productService
+
+    def getReceiptService(self) -> 'ReceiptService':
+        with self._lock:
+            product_service = self.getProductService()
+
+            if self._receiptService is None or self._receiptService.isStale():
+                from receipt import ReceiptService
+                if self._receiptService is not None:
+                    self._receiptService.close()
+                self._receiptService = ReceiptService(product_service, self._getBackend(), self._shared, **self._write_settings)
+
+            return self._receiptService
+
+    def close(self):
+        # Writes any receipts still waiting in the receipt service
+        with self._lock:
+            if self._receiptService is not None:
+                self._receiptService.close()
+                self._receiptService = None
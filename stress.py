@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+from bench import makeCatalog
+from database import makeBackend
+from store import DataStore
+
+
+def _runLane(directory:str, backend:str, threads:int, receipts:int, product_ids:list):
+    # One checkout lane (process) with several threads paying at the same time
+    os.chdir(directory)
+    store = DataStore('products.txt', makeBackend(backend), shared = True)
+    product_service = store.getProductService()
+    receipt_service = store.getReceiptService()
+
+    def pay():
+        for _ in range(receipts):
+            new_receipt = receipt_service.createNewReceipt()
+
+            for product_id in product_ids:
+                prod = product_service.findProduct(product_id)
+                prod.setAmount(1)
+                new_receipt.addProduct(prod)
+
+            receipt_service.addNewReceipt(new_receipt)
+
+    workers = [threading.Thread(target = pay) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    store.close()
+
+
+def checkReceipts(receipt_service, lines_per_receipt:int) -> list:
+    # Returns a list of problems found in the receipt files, empty if none:
+    # rows with the wrong number of fields (torn rows), receipts whose rows
+    # are not next to each other (interleaved writes), serial numbers used by
+    # more than one receipt, and receipts the index cannot find.
+    problems = []
+    finished_serial_nrs = set()
+
+    for date, db in sorted(receipt_service.getDatabases().items()):
+        last_serial_nr = None
+        line_count = 0
+
+        for row in list(db.iterRows()) + [None]:
+            if row is not None and len(row) != len(receipt_service._colnames):
+                problems.append(f"{date}: torn row {row}")
+                continue
+
+            serial_nr = row[0] if row is not None else None
+
+            if serial_nr != last_serial_nr:
+                if last_serial_nr is not None and line_count != lines_per_receipt:
+                    problems.append(f"{date}: receipt {last_serial_nr} has {line_count} rows")
+
+                if serial_nr is not None and serial_nr in finished_serial_nrs:
+                    problems.append(f"{date}: serial number {serial_nr} used again or interleaved")
+
+                if last_serial_nr is not None:
+                    finished_serial_nrs.add(last_serial_nr)
+                last_serial_nr = serial_nr
+                line_count = 0
+
+            line_count += 1
+
+    for serial_nr in finished_serial_nrs:
+        receipt = receipt_service.findReceipt(serial_nr)
+        if receipt is None or len(receipt.getProducts()) != lines_per_receipt:
+            problems.append(f"receipt {serial_nr} not found through the index")
+
+    return problems
+
+
+def checkOutOfOrderPayment(backend:str, product_id:str) -> list:
+    # Two shared lanes reserve serial numbers and pay in the opposite order,
+    # so the last row in the file is not the highest number. A single lane
+    # started afterwards must still give out a new number.
+    # Runs against the files in the current directory.
+    stores = [DataStore('products.txt', makeBackend(backend), shared = True) for _ in range(2)]
+    receipts = [store.getReceiptService().createNewReceipt() for store in stores]
+
+    for store, receipt in reversed(list(zip(stores, receipts))):
+        prod = store.getProductService().findProduct(product_id)
+        receipt.addProduct(prod)
+        store.getReceiptService().addNewReceipt(receipt)
+        store.close()
+
+    store = DataStore('products.txt', makeBackend(backend))
+    serial_nr = store.getReceiptService().createNewReceipt().getSerialNr()
+    store.close()
+
+    used_serial_nrs = [receipt.getSerialNr() for receipt in receipts]
+    if int(serial_nr) <= max(int(used) for used in used_serial_nrs):
+        return [f"single lane got serial number {serial_nr} after shared lanes used {used_serial_nrs}"]
+
+    return []
+
+
+def runStressTest(lanes = 4, threads = 3, receipts = 40, backend = 'csv') -> dict:
+    # Runs lanes processes with threads threads each, every thread paying
+    # receipts receipts against the same files in a temporary directory.
+    # Returns the number of receipts found and the problems found.
+    old_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        try:
+            setup_backend = makeBackend(backend)
+            product_ids = makeCatalog(setup_backend, 10)[:3]
+            setup_backend.close()
+
+            processes = [multiprocessing.Process(target = _runLane, args = (directory, backend, threads, receipts, product_ids))
+                         for _ in range(lanes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+            store = DataStore('products.txt', makeBackend(backend))
+            receipt_service = store.getReceiptService()
+            problems = [f"lane ended with exit code {process.exitcode}" for process in processes if process.exitcode != 0]
+            problems += checkReceipts(receipt_service, len(product_ids))
+
+            receipt_count = len(set(row[0] for db in receipt_service.getDatabases().values() for row in db.iterRows()))
+            if receipt_count != lanes * threads * receipts:
+                problems.append(f"{receipt_count} receipts written, expected {lanes * threads * receipts}")
+
+            store.close()
+
+            problems += checkOutOfOrderPayment(backend, product_ids[0])
+        finally:
+            os.chdir(old_directory)
+
+    return {'receipts':receipt_count, 'problems':problems}
+
+
+if __name__ == '__main__':
+    # python stress.py [lanes] [threads per lane] [receipts per thread] [csv|sqlite]
+    numbers = [int(arg) for arg in sys.argv[1:4]]
+    result = runStressTest(*numbers, *sys.argv[4:5])
+
+    print(f"{result['receipts']} kvitton")
+    for problem in result['problems']:
+        print(problem)
+
+    if len(result['problems']) > 0:
+        sys.exit(1)
+    print('Inga fel')
@@ -0,0 +1,177 @@
+import json
+import os
+from database import CSVdb
+
+
+class DaySummary:
+    # Totals for one receipt file. The rows themselves are cached separately,
+    # see DayRowCache, so reports only load the totals.
+
+    def __init__(self, date:str):
+        self._date = date
+        self._revenue = 0.0
+        self._receipt_count = 0
+        self._line_count = 0
+        self._unit_count = 0.0
+        self._last_serial_nr = None
+        # product id -> [description, units, revenue, campaign units, campaign revenue]
+        # A list and not a dict, it is stored for every product of every day
+        self._products = {}
+
+    @classmethod
+    def fromDb(cls, date:str, db:CSVdb) -> 'DaySummary':
+        summary = cls(date)
+
+        # A full scan, iterRows is faster than the mapped reader for that
+        for row in db.iterRows():
+            summary.addRow(row)
+
+        return summary
+
+    def addRow(self, row:list):
+        # row as in the receipt file:
+        # serial_nr, time, product_id, product_description, amount, price, type, campaign
+        serial_nr, _, product_id, description, amount, price, _, campaign = row
+        amount = float(amount)
+        revenue = amount * float(price)
+
+        if serial_nr != self._last_serial_nr:
+            self._receipt_count += 1
+            self._last_serial_nr = serial_nr
+
+        product = self._products.get(product_id)
+        if product is None:
+            product = [description, 0.0, 0.0, 0.0, 0.0]
+            self._products[product_id] = product
+
+        product[1] += amount
+        product[2] += revenue
+        if campaign == 'yes':
+            product[3] += amount
+            product[4] += revenue
+
+        self._revenue += revenue
+        self._line_count += 1
+        self._unit_count += amount
+
+    def toDict(self) -> dict:
+        return {'date':self._date, 'revenue':self._revenue, 'receipt_count':self._receipt_count,
+                'line_count':self._line_count, 'unit_count':self._unit_count,
+                'last_serial_nr':self._last_serial_nr, 'products':self._products}
+
+    @classmethod
+    def fromDict(cls, data:dict) -> 'DaySummary':
+        summary = cls(data['date'])
+        summary._revenue = data['revenue']
+        summary._receipt_count = data['receipt_count']
+        summary._line_count = data['line_count']
+        summary._unit_count = data['unit_count']
+        summary._last_serial_nr = data['last_serial_nr']
+        summary._products = data['products']
+        return summary
+
+    def getDate(self) -> str:
+        return self._date
+
+    def getRevenue(self) -> float:
+        return self._revenue
+
+    def getReceiptCount(self) -> int:
+        return self._receipt_count
+
+    def getLineCount(self) -> int:
+        return self._line_count
+
+    def getUnitCount(self) -> float:
+        return self._unit_count
+
+    def getLastSerialNr(self) -> str:
+        return self._last_serial_nr
+
+    def getProducts(self) -> dict:
+        return self._products
+
+
+class DaySummaryCache:
+    # Keeps a summary_yyyymmdd.json next to each closed receipt file (a day
+    # that is over and will not get more receipts). The cache file remembers
+    # the mtime and size of the receipt file it was made from, and is made
+    # again if the receipt file has changed since.
+
+    filename_format = 'summary_{}.json'
+    # Files written with another version are made again (version 1 also held the rows)
+    version = 2
+
+    def getSummary(self, date:str, db:CSVdb, closed:bool) -> DaySummary:
+        stamp = db.getFileStamp()
+        filename = self.filename_format.format(date)
+
+        if closed:
+            try:
+                with open(filename, 'r') as f:
+                    data = json.load(f)
+
+                if data.get('version') == self.version and data['stamp'] == list(stamp):
+                    return DaySummary.fromDict(data['summary'])
+
+            except (OSError, ValueError, KeyError, TypeError):
+                # Missing or broken cache file, made again below
+                pass
+
+        summary = DaySummary.fromDb(date, db)
+
+        if closed:
+            self._saveSummary(filename, stamp, summary)
+
+        return summary
+
+    def _saveSummary(self, filename:str, stamp:tuple, summary:DaySummary):
+        # Written to a temporary file first so a crash never leaves half a cache file
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, 'w') as f:
+            json.dump({'version':self.version, 'stamp':list(stamp), 'summary':summary.toDict()}, f)
+
+        os.replace(temp_filename, filename)
+
+
+class DayRowCache:
+    # Keeps the rows of each closed receipt file, already split into fields,
+    # in rows_yyyymmdd.json, so loading an old day's receipts does not parse
+    # the csv again. Made again when the receipt file changes, like the
+    # summaries. JSON and not pickle, so a file dropped in the directory can
+    # never run code; a file that can not be used is made again.
+
+    filename_format = 'rows_{}.json'
+
+    def getRows(self, date:str, db:CSVdb, closed:bool, rebuild = False) -> list:
+        # rebuild: do not use the cache file, e.g. when its rows could not be used
+        if not closed:
+            return list(db.iterRows())
+
+        stamp = db.getFileStamp()
+        filename = self.filename_format.format(date)
+
+        if not rebuild:
+            try:
+                with open(filename, 'r') as f:
+                    data = json.load(f)
+
+                rows = data['rows']
+                width = len(db._colnames)
+
+                if data['stamp'] == list(stamp) and type(rows) == list and all(type(row) == list and len(row) == width for row in rows):
+                    return rows
+
+            except (OSError, ValueError, KeyError, TypeError):
+                # Missing or broken cache file, made again below
+                pass
+
+        rows = list(db.iterRows())
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, 'w') as f:
+            json.dump({'stamp':list(stamp), 'rows':rows}, f, separators = (',', ':'))
+
+        os.replace(temp_filename, filename)
+        return rows